@@ -1,23 +1,46 @@
 import requests
 import os
+import sys
 import json
 import glob
-import smtplib
-import ssl
-import imaplib
 import datetime
 import logging
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from jinja2 import Environment
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from datetime import time
-from requests.adapters import HTTPAdapter
+from datetime import timedelta
+from datetime import timezone
 from urllib3 import Retry
 from dotenv import load_dotenv
+from netcore_sync.metrics import Metrics
+from netcore_sync.rate_limit import DEFAULT_MAX_RATE, DEFAULT_RATE, RateLimitedAdapter, RateLimiter
+from netcore_sync.tokens import TokenManager
+
+# Columns of the RE email list kept in Databases/Email List.parquet
+EMAIL_LIST_SCHEMA = pa.schema([
+    ('address', pa.string()),
+    ('constituent_id', pa.string()),
+    ('id', pa.string()),
+    ('inactive', pa.bool_()),
+    ('primary', pa.bool_())
+])
+
+# The list leaves out inactive emails unless asked for them, which the upload script needs to skip bounces already
+# inactive in RE, so every download (full or incremental) asks for the same rows
+EMAIL_LIST_PARAMS = {'include_inactive': True}
+
+# High-water mark of the last successful email list sync
+SYNC_STATE = 'Databases/Email List Sync.json'
+
+# Re-fetch a little before the high-water mark, to allow for clock drift between us and RE
+HIGH_WATER_MARK_OVERLAP = timedelta(minutes=15)
+
+# Set by the first run, and kept by the ones after it when run by netcore_sync.daemon
+is_set_up = False
 
 def set_current_directory():
     logging.info('Setting current directory')
@@ -25,13 +48,16 @@ def set_current_directory():
     os.chdir(os.getcwd())
 
 def start_logging():
-    global process_name
+    global process_name, log_handler
 
     # Get File Name of existing script
     process_name = os.path.basename(__file__).replace('.py', '').replace(' ', '_')
 
-    logging.basicConfig(filename=f'Logs/{process_name}.log', format='%(asctime)s %(message)s', filemode='w',
-                        level=logging.DEBUG)
+    # A handler of its own, so that every run (in netcore_sync.daemon too) starts a fresh log of the script
+    log_handler = logging.FileHandler(f'Logs/{process_name}.log', mode='w')
+    log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logging.getLogger().addHandler(log_handler)
+    logging.getLogger().setLevel(logging.DEBUG)
 
     # Printing the output to file for debugging
     logging.info('Starting the Script')
@@ -39,6 +65,18 @@ def start_logging():
 def stop_logging():
     logging.info('Stopping the Script')
 
+def start_metrics():
+    logging.info('Starting the metrics of this run')
+
+    global metrics
+
+    # Stage timings and request counts, appended to Logs/Metrics.jsonl at the end of the run
+    metrics = Metrics(process_name)
+
+def record_response(response, *args, **kwargs):
+    # requests response hook, counting every response towards the metrics of the current run
+    metrics.record_response(response, *args, **kwargs)
+
 def housekeeping():
     logging.info('Doing Housekeeping')
 
@@ -61,26 +99,39 @@ def set_api_request_strategy():
     # API Request strategy
     logging.info('Setting API Request Strategy')
 
+    # Retry connection errors here, throttled and failed responses are retried by the adapter
     retry_strategy = Retry(
         total=3,
-        status_forcelist=[429, 500, 502, 503, 504],
         allowed_methods=['HEAD', 'GET', 'OPTIONS'],
         backoff_factor=10
     )
 
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    # Pace requests from all the workers to stay under the SKY API quota
+    limiter = RateLimiter(rate=RE_API_RATE, max_rate=RE_API_MAX_RATE)
+
+    # Size the connection pool so that every worker can hold a connection
+    adapter = RateLimitedAdapter(limiter, max_retries=retry_strategy, pool_maxsize=max(DOWNLOAD_WORKERS, 10))
     http = requests.Session()
     http.mount('https://', adapter)
     http.mount('http://', adapter)
 
+    # Count every response towards the metrics of this run
+    http.hooks['response'].append(record_response)
+
 def get_env_variables():
     logging.info('Setting Environment variables')
 
-    global RE_API_KEY, MAIL_USERN, MAIL_PASSWORD, IMAP_URL, IMAP_PORT, SMTP_URL, SMTP_PORT, SEND_TO
+    global AUTH_CODE, RE_API_KEY, RE_API_URL, RE_OAUTH_URL, MAIL_USERN, MAIL_PASSWORD, IMAP_URL, IMAP_PORT, SMTP_URL, SMTP_PORT, SEND_TO
+    global DOWNLOAD_MODE, DOWNLOAD_WORKERS, INCREMENTAL_SYNC, FULL_REFRESH_DAYS, RE_API_RATE, RE_API_MAX_RATE
 
     load_dotenv()
 
+    AUTH_CODE = os.getenv('AUTH_CODE')
     RE_API_KEY = os.getenv('RE_API_KEY')
+
+    # Where the SKY API lives, which can be pointed at netcore_sync.mock_sky_api for testing
+    RE_API_URL = os.getenv('RE_API_URL', 'https://api.sky.blackbaud.com')
+    RE_OAUTH_URL = os.getenv('RE_OAUTH_URL', 'https://oauth2.sky.blackbaud.com')
     MAIL_USERN = os.getenv('MAIL_USERN')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     IMAP_URL = os.getenv('IMAP_URL')
@@ -89,9 +140,31 @@ def get_env_variables():
     SMTP_PORT = os.getenv('SMTP_PORT')
     SEND_TO = os.getenv('SEND_TO')
 
+    # 'stream' writes each page straight to Parquet instead of going through JSON files
+    # 'parallel' does the same, fetching DOWNLOAD_WORKERS pages at a time
+    DOWNLOAD_MODE = os.getenv('DOWNLOAD_MODE', 'json')
+    DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 4))
+
+    # Only download emails modified since the last run, with a full refresh every few days
+    INCREMENTAL_SYNC = os.getenv('INCREMENTAL_SYNC', 'false').lower() == 'true'
+    FULL_REFRESH_DAYS = int(os.getenv('FULL_REFRESH_DAYS', 7))
+
+    # Requests per second to start at and never to go beyond, across all the workers
+    RE_API_RATE = float(os.getenv('RE_API_RATE', DEFAULT_RATE))
+    RE_API_MAX_RATE = float(os.getenv('RE_API_MAX_RATE', DEFAULT_MAX_RATE))
+
 def send_error_emails(subject):
     logging.info('Sending email for an error')
 
+    # Only needed when something's gone wrong, so they're left out of every other run
+    import imaplib
+    import smtplib
+    import ssl
+    import time
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from jinja2 import Environment
+
     message = MIMEMultipart()
     message["Subject"] = subject
     message["From"] = MAIL_USERN
@@ -186,6 +259,8 @@ def send_error_emails(subject):
         imap.logout()
 
 def attach_file_to_email(message, filename):
+    from email.mime.application import MIMEApplication
+
     # Open the attachment file for reading in binary mode, and make it a MIMEApplication class
     with open(filename, "rb") as f:
         file_attachment = MIMEApplication(f.read())
@@ -199,15 +274,13 @@ def attach_file_to_email(message, filename):
     # Attach the file to the message
     message.attach(file_attachment)
 
-def retrieve_token():
-
-    logging.info('Retrieve token for API connections')
+def set_token_manager():
+    logging.info('Setting up the token manager')
 
-    with open('access_token_output.json') as access_token_output:
-        data = json.load(access_token_output)
-        access_token = data['access_token']
+    global token_manager
 
-    return access_token
+    # Loads the token once and refreshes it shortly before it expires
+    token_manager = TokenManager(http, AUTH_CODE, oauth_url=RE_OAUTH_URL)
 
 def pagination_api_request(url, params):
     # Pagination request to retreive list
@@ -227,7 +300,9 @@ def pagination_api_request(url, params):
         with open(f'API_Response_RE_{process_name}_{i}.json') as list_output_last:
 
             if 'next_link' in list_output_last.read():
+                # The next link already carries the query parameters
                 url = re_api_response['next_link']
+                params = {}
 
             else:
                 break
@@ -259,9 +334,177 @@ def load_from_json_to_parquet():
             except:
                 df = df_.copy()
 
-    # export from dataframe to parquet
-    df = df[['address', 'constituent_id', 'id']]
-    df.to_parquet('Databases/Email List.parquet', index=False)
+    # export from dataframe to parquet, keeping the columns (and types) of the email list
+    df = df.reindex(columns=EMAIL_LIST_SCHEMA.names)
+    pq.write_table(pa.Table.from_pandas(df, schema=EMAIL_LIST_SCHEMA, preserve_index=False),
+                   'Databases/Email List.parquet')
+
+def get_pages(url, params):
+    # Pagination request to retreive list, one page at a time
+    while url:
+        # Blackbaud API GET request
+        get_request_re(url, params)
+
+        yield re_api_response
+
+        # The next link already carries the query parameters
+        url = re_api_response.get('next_link')
+        params = {}
+
+def get_pages_in_parallel(url, params):
+    # The first page tells us how many records there are
+    first_page = get_request_re(url, params)
+
+    yield first_page
+
+    page_size = len(first_page['value'])
+
+    if page_size == 0:
+        return
+
+    offsets = range(page_size, first_page['count'], page_size)
+
+    logging.info(f'Fetching {len(offsets)} more pages with {DOWNLOAD_WORKERS} workers')
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        pending = deque()
+
+        # Keep a few pages in flight, handing them back in order
+        for offset in offsets:
+            pending.append(executor.submit(get_request_re, url, {**params, 'offset': offset}))
+
+            if len(pending) >= DOWNLOAD_WORKERS * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def get_all_pages(url, params):
+    if DOWNLOAD_MODE == 'parallel':
+        return get_pages_in_parallel(url=url, params=params)
+
+    return get_pages(url=url, params=params)
+
+def normalise_page(page):
+    # Load from JSON to pandas, keeping only the columns needed
+    df = pd.json_normalize(page['value']).reindex(columns=EMAIL_LIST_SCHEMA.names)
+
+    return pa.Table.from_pandas(df, schema=EMAIL_LIST_SCHEMA, preserve_index=False)
+
+def stream_to_parquet(pages, destination):
+    logging.info(f'Streaming pages to {destination}')
+
+    # Write to a temporary file, so that a failed download leaves the existing list untouched
+    temporary_file = f'{destination}.tmp'
+
+    try:
+        with pq.ParquetWriter(temporary_file, EMAIL_LIST_SCHEMA) as writer:
+
+            # Each page becomes a row group of its own
+            for page in pages:
+                writer.write_table(normalise_page(page))
+
+    except:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
+
+    os.replace(temporary_file, destination)
+
+def download_email_list(url, params):
+    logging.info('Downloading the complete list of RE emails')
+
+    if DOWNLOAD_MODE in ['stream', 'parallel']:
+        # Stream to Parquet, normalising each page as it arrives
+        with metrics.stage('download'):
+            stream_to_parquet(get_all_pages(url=url, params=params), 'Databases/Email List.parquet')
+
+    else:
+        with metrics.stage('download'):
+            pagination_api_request(url=url, params=params)
+
+        # Load from JSON
+        with metrics.stage('normalise'):
+            load_from_json_to_parquet()
+
+    metrics.add_rows('download', pq.read_metadata('Databases/Email List.parquet').num_rows)
+
+def load_sync_state():
+    logging.info('Loading the high-water mark of the last sync')
+
+    if os.path.exists(SYNC_STATE):
+        with open(SYNC_STATE) as sync_state:
+            return json.load(sync_state)
+
+    return {}
+
+def save_sync_state(sync_state):
+    logging.info('Saving the high-water mark of this sync')
+
+    # Replace the file in one go, so that a crash never leaves a half written mark
+    with open(f'{SYNC_STATE}.tmp', 'w') as sync_state_output:
+        json.dump(sync_state, sync_state_output, ensure_ascii=False, sort_keys=True, indent=4)
+
+    os.replace(f'{SYNC_STATE}.tmp', SYNC_STATE)
+
+def needs_full_refresh(sync_state):
+    # Asked for on the command line
+    if '--full-refresh' in sys.argv:
+        return True
+
+    # Nothing to build on
+    if 'last_modified' not in sync_state or not os.path.exists('Databases/Email List.parquet'):
+        return True
+
+    # Deleted emails never show up as modified, so pick them up with a periodic full refresh
+    last_full_refresh = datetime.fromisoformat(sync_state.get('last_full_refresh', sync_state['last_modified']))
+
+    return datetime.now(timezone.utc) - last_full_refresh > timedelta(days=FULL_REFRESH_DAYS)
+
+def merge_email_changes(changes):
+    logging.info(f'Merging {changes.shape[0]} modified emails into the email list')
+
+    # Lists saved before the inactive and primary flags were kept have them blank until the next full refresh
+    email_list = pd.read_parquet('Databases/Email List.parquet').reindex(columns=EMAIL_LIST_SCHEMA.names)
+
+    # Replace the old version of every modified email and add the new ones
+    email_list = pd.concat([email_list[~email_list['id'].isin(changes['id'])], changes], ignore_index=True)
+
+    email_list.to_parquet('Databases/Email List.parquet.tmp', index=False)
+    os.replace('Databases/Email List.parquet.tmp', 'Databases/Email List.parquet')
+
+def sync_email_list(url):
+    logging.info('Syncing RE emails modified since the last run')
+
+    sync_state = load_sync_state()
+
+    # Anything modified from here on is picked up by the next run
+    started = datetime.now(timezone.utc)
+
+    if needs_full_refresh(sync_state):
+        download_email_list(url=url, params=EMAIL_LIST_PARAMS)
+        sync_state['last_full_refresh'] = started.isoformat()
+
+    else:
+        since = datetime.fromisoformat(sync_state['last_modified']) - HIGH_WATER_MARK_OVERLAP
+
+        params = {
+            **EMAIL_LIST_PARAMS,
+            'last_modified': since.isoformat()
+        }
+
+        with metrics.stage('download'):
+            changes = pd.concat(
+                [normalise_page(page).to_pandas() for page in get_all_pages(url=url, params=params)], ignore_index=True
+            )
+
+        metrics.add_rows('download', changes.shape[0])
+
+        with metrics.stage('merge'):
+            merge_email_changes(changes)
+
+    sync_state['last_modified'] = started.isoformat()
+    save_sync_state(sync_state)
 
 def get_request_re(url, params):
     global re_api_response
@@ -272,15 +515,17 @@ def get_request_re(url, params):
     headers = {
         # Request headers
         'Bb-Api-Subscription-Key': RE_API_KEY,
-        'Authorization': 'Bearer ' + retrieve_token(),
     }
 
-    re_api_response = http.get(url, params=params, headers=headers).json()
+    response = token_manager.request('GET', url, params=params, headers=headers).json()
+    re_api_response = response
 
-try:
+    return response
 
-    # Start Logging for Debugging
-    start_logging()
+def setup():
+    logging.info('Setting up the session and token kept between runs')
+
+    global is_set_up
 
     # Set current directory
     set_current_directory()
@@ -288,32 +533,63 @@ try:
     # Retrieve contents from .env file
     get_env_variables()
 
-    # Housekeeping
-    housekeeping()
-
     # Set API Request strategy
     set_api_request_strategy()
 
-    # Get List of Alums with Email
-    url = 'https://api.sky.blackbaud.com/constituent/v1/emailaddresses?limit=5000'
-    params = {}
-    pagination_api_request(url=url, params=params)
+    # Set up the token manager
+    set_token_manager()
+
+    is_set_up = True
 
-    # Load from JSON
-    load_from_json_to_parquet()
+def main():
+    global Argument
 
-except Exception as Argument:
+    try:
 
-    logging.error(Argument)
+        # Start recording metrics
+        start_metrics()
 
-    send_error_emails('Error while downloading Emails | Netcore Sync')
+        # Only the first run sets up, later ones (in netcore_sync.daemon) reuse the session and token
+        if not is_set_up:
+            setup()
 
-finally:
+        # Housekeeping
+        housekeeping()
 
-    # Housekeeping
-    housekeeping()
+        # Get List of Alums with Email
+        url = f'{RE_API_URL}/constituent/v1/emailaddresses?limit=5000'
+        params = EMAIL_LIST_PARAMS
+
+        if INCREMENTAL_SYNC:
+            sync_email_list(url=url)
+
+        else:
+            download_email_list(url=url, params=params)
+
+    except Exception as Argument:
+
+        logging.error(Argument)
+        metrics.fail(Argument)
+
+        send_error_emails('Error while downloading Emails | Netcore Sync')
+
+    finally:
+
+        # Save the metrics of this run
+        metrics.write()
+
+        # Housekeeping
+        housekeeping()
+
+if __name__ == '__main__':
+
+    # Start Logging for Debugging
+    start_logging()
+
+    # Run once
+    main()
 
     # Stop Logging
     stop_logging()
 
-    exit()
\ No newline at end of file
+    exit()
@@ -1,46 +1,46 @@
-import json
 import requests
 import os
 import logging
 import sys
-import ssl
-import smtplib
-import imaplib
 from dotenv import load_dotenv
-from requests.adapters import HTTPAdapter
 from urllib3 import Retry
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from jinja2 import Environment
 from datetime import datetime
-from datetime import time
+from netcore_sync.metrics import Metrics
+from netcore_sync.rate_limit import RateLimitedAdapter
+from netcore_sync.tokens import TokenManager
+
+# Set by the first run, and kept by the ones after it when run by netcore_sync.daemon
+is_set_up = False
 
 
 def api_request_strategy():
     global http
 
+    # Retry connection errors here, throttled and failed responses are retried by the adapter
     retry_strategy = Retry(
         total=3,
-        status_forcelist=[429, 500, 502, 503, 504],
         allowed_methods=['HEAD', 'GET', 'OPTIONS'],
         backoff_factor=10
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = RateLimitedAdapter(max_retries=retry_strategy)
     http = requests.Session()
     http.mount('https://', adapter)
     http.mount('http://', adapter)
 
+    # Count every response towards the metrics of this run
+    http.hooks['response'].append(record_response)
+
 
 def set_directory():
     os.chdir(os.getcwd())
 
 
 def load_env():
-    global AUTH_CODE, MAIL_USERN, MAIL_PASSWORD, IMAP_URL, IMAP_PORT, SMTP_URL, SMTP_PORT, SEND_TO
+    global AUTH_CODE, RE_OAUTH_URL, MAIL_USERN, MAIL_PASSWORD, IMAP_URL, IMAP_PORT, SMTP_URL, SMTP_PORT, SEND_TO
 
     load_dotenv()
     AUTH_CODE = os.getenv('AUTH_CODE')
+    RE_OAUTH_URL = os.getenv('RE_OAUTH_URL', 'https://oauth2.sky.blackbaud.com')
     MAIL_USERN = os.getenv('MAIL_USERN')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     IMAP_URL = os.getenv('IMAP_URL')
@@ -50,45 +50,29 @@ def load_env():
     SEND_TO = os.getenv('SEND_TO')
 
 
-def retrieve_refresh_token():
-    with open('access_token_output.json') as access_token_output:
-        data = json.load(access_token_output)
-        refresh_token = data["refresh_token"]
+def set_token_manager():
+    global token_manager
 
-    return refresh_token
+    # Kept between runs in netcore_sync.daemon, which then only reads the token file when it's changed
+    token_manager = TokenManager(http, AUTH_CODE, oauth_url=RE_OAUTH_URL)
 
 
 def get_token():
-    url = 'https://oauth2.sky.blackbaud.com/token'
-
-    # Request Headers for Blackbaud API request
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'Authorization': 'Basic ' + AUTH_CODE
-    }
-
-    # Request parameters for Blackbaud API request
-    data = {
-        'grant_type': 'refresh_token',
-        'refresh_token': retrieve_refresh_token()
-    }
-
-    # API Request
-    response = http.post(url, data=data, headers=headers).json()
-
-    # Write output to JSON file
-    with open('access_token_output.json', 'w') as response_output:
-        json.dump(response, response_output, ensure_ascii=False, sort_keys=True, indent=4)
+    # Refresh the token and save it for the other scripts
+    token_manager.refresh()
 
 
 def start_logging():
-    global process_name
+    global process_name, log_handler
 
     # Get File Name of existing script
     process_name = os.path.basename(__file__).replace('.py', '').replace(' ', '_')
 
-    logging.basicConfig(filename=f'Logs/{process_name}.log', format='%(asctime)s %(message)s', filemode='w',
-                        level=logging.DEBUG)
+    # A handler of its own, so that every run (in netcore_sync.daemon too) starts a fresh log of the script
+    log_handler = logging.FileHandler(f'Logs/{process_name}.log', mode='w')
+    log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logging.getLogger().addHandler(log_handler)
+    logging.getLogger().setLevel(logging.DEBUG)
 
     # Printing the output to file for debugging
     logging.info('Starting the Script')
@@ -98,9 +82,30 @@ def stop_logging():
     logging.info('Stopping the Script')
 
 
+def start_metrics():
+    global metrics
+
+    # Stage timings and request counts, appended to Logs/Metrics.jsonl at the end of the run
+    metrics = Metrics(process_name)
+
+
+def record_response(response, *args, **kwargs):
+    # requests response hook, counting every response towards the metrics of the current run
+    metrics.record_response(response, *args, **kwargs)
+
+
 def send_error_emails(subject):
     logging.info('Sending email for an error')
 
+    # Only needed when something's gone wrong, so they're left out of every other run
+    import imaplib
+    import smtplib
+    import ssl
+    import time
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from jinja2 import Environment
+
     message = MIMEMultipart()
     message["Subject"] = subject
     message["From"] = MAIL_USERN
@@ -196,6 +201,8 @@ def send_error_emails(subject):
 
 
 def attach_file_to_email(message, filename):
+    from email.mime.application import MIMEApplication
+
     # Open the attachment file for reading in binary mode, and make it a MIMEApplication class
     with open(filename, "rb") as f:
         file_attachment = MIMEApplication(f.read())
@@ -216,31 +223,61 @@ def exit():
     sys.exit()
 
 
-try:
+def setup():
+    global is_set_up
 
     # Set current directory
     set_directory()
 
-    # Start Logging
-    start_logging()
-
     # Set API Request strategy
     api_request_strategy()
 
     # Load env variables
     load_env()
 
-    # Blackbaud Token URL
-    get_token()
+    # Set up the token manager
+    set_token_manager()
 
-except Exception as Argument:
-    logging.error(Argument)
-    send_error_emails('Error while refreshing token | Location to State, City and Country v4')
+    is_set_up = True
+
+
+def main():
+    global Argument
+
+    try:
+
+        # Start recording metrics
+        start_metrics()
+
+        # Only the first run sets up, later ones (in netcore_sync.daemon) reuse the session and token
+        if not is_set_up:
+            setup()
+
+        # Blackbaud Token URL
+        with metrics.stage('refresh'):
+            get_token()
+
+    except Exception as Argument:
+        logging.error(Argument)
+        metrics.fail(Argument)
+        send_error_emails('Error while refreshing token | Location to State, City and Country v4')
+
+    finally:
+
+        # Save the metrics of this run
+        metrics.write()
+
+
+if __name__ == '__main__':
+
+    # Start Logging
+    start_logging()
 
-finally:
+    # Run once
+    main()
 
     # Stop Logging
     stop_logging()
 
     # Exit
-    exit()
\ No newline at end of file
+    exit()
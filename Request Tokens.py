@@ -1,8 +1,8 @@
-import json
 import requests
 import os
 
 from dotenv import load_dotenv
+from netcore_sync.tokens import save_token
 
 
 def set_directory():
@@ -10,7 +10,7 @@ def set_directory():
 
 
 def load_env():
-    global AUTH_CODE, REDIRECT_URL, CLIENT_ID
+    global AUTH_CODE, REDIRECT_URL, CLIENT_ID, RE_OAUTH_URL
 
     load_dotenv()
 
@@ -19,13 +19,14 @@ def load_env():
     AUTH_CODE = os.getenv("AUTH_CODE")
     REDIRECT_URL = os.getenv("REDIRECT_URL")
     CLIENT_ID = os.getenv("CLIENT_ID")
+    RE_OAUTH_URL = os.getenv("RE_OAUTH_URL", "https://oauth2.sky.blackbaud.com")
 
 
 def get_token():
     # Blackbaud Token URL
-    url = 'https://oauth2.sky.blackbaud.com/token'
+    url = f'{RE_OAUTH_URL}/token'
 
-    url_for_user = f'https://oauth2.sky.blackbaud.com/authorization?client_id={CLIENT_ID}&response_type=code&redirect_uri={REDIRECT_URL}&state=fdf80155'
+    url_for_user = f'{RE_OAUTH_URL}/authorization?client_id={CLIENT_ID}&response_type=code&redirect_uri={REDIRECT_URL}&state=fdf80155'
 
     print("Please go to this link to get your access code " + url_for_user)
 
@@ -49,8 +50,7 @@ def get_token():
     response = requests.post(url, data=data, headers=headers).json()
 
     # Write output to JSON file
-    with open("access_token_output.json", "w") as response_output:
-        json.dump(response, response_output, ensure_ascii=False, sort_keys=True, indent=4)
+    save_token(response)
 
 
 try:
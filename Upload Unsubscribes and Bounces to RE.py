@@ -1,35 +1,62 @@
-import requests
 import os
+import sys
+
+from netcore_sync.fingerprint import skip_if_unchanged
+
+# Most runs have nothing new to upload, which is worth finding out before importing pandas and the rest
+if __name__ == '__main__' and skip_if_unchanged(os.path.basename(__file__).replace('.py', '').replace(' ', '_')):
+    sys.exit()
+
+import requests
 import json
-import smtplib
-import ssl
-import imaplib
 import datetime
 import logging
 import pandas as pd
+import pyarrow.dataset as ds
 
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from jinja2 import Environment
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from datetime import time
-from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 from dotenv import load_dotenv
+from netcore_sync.checkpoint import RunCheckpoint
+from netcore_sync.diff import HARD_BOUNCE_KEYS, UNSUBSCRIBE_KEYS, find_new_rows, hash_keys, load_history_hashes, with_key_hashes
+from netcore_sync.engagement import read_engagement, recent_months
+from netcore_sync.fingerprint import InputFingerprint
+from netcore_sync.metrics import Metrics
+from netcore_sync.rate_limit import DEFAULT_MAX_RATE, DEFAULT_RATE, RateLimitedAdapter, RateLimiter
+from netcore_sync.state_store import EMAIL_LIST, StateStore, get_fingerprint
+from netcore_sync.tokens import TokenManager
+from netcore_sync.write_queue import WriteQueue, is_permanent_failure
+
+# Unsubscribes and Hard Bounces uploaded to RE since the last compaction, one JSON record per line
+UNSUBSCRIBES_LEDGER = 'Databases/Unsubscribes Ledger.jsonl'
+HARD_BOUNCES_LEDGER = 'Databases/Hard Bounces Ledger.jsonl'
+
+# Fold a ledger into its Parquet file after these many records
+LEDGER_COMPACT_EVERY = 1000
+
+# Unsubscribes listed in the statement of a consent, beyond which they're just counted
+CONSENT_STATEMENT_LINES = 20
+
+# Set by the first run, and kept by the ones after it when run by netcore_sync.daemon
+is_set_up = False
+email_list_fingerprint = None
 
 def set_current_directory():
     logging.info('Setting current directory')
     os.chdir(os.getcwd())
 
 def start_logging():
-    global process_name
+    global process_name, log_handler
 
     # Get File Name of existing script
     process_name = os.path.basename(__file__).replace('.py', '').replace(' ', '_')
 
-    logging.basicConfig(filename=f'Logs/{process_name}.log', format='%(asctime)s %(message)s', filemode='w',
-                        level=logging.DEBUG)
+    # A handler of its own, so that every run (in netcore_sync.daemon too) starts a fresh log of the script
+    log_handler = logging.FileHandler(f'Logs/{process_name}.log', mode='w')
+    log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logging.getLogger().addHandler(log_handler)
+    logging.getLogger().setLevel(logging.DEBUG)
 
     # Printing the output to file for debugging
     logging.info('Starting the Script')
@@ -37,31 +64,56 @@ def start_logging():
 def stop_logging():
     logging.info('Stopping the Script')
 
+def start_metrics():
+    logging.info('Starting the metrics of this run')
+
+    global metrics
+
+    # Stage timings and request counts, appended to Logs/Metrics.jsonl at the end of the run
+    metrics = Metrics(process_name)
+
+def record_response(response, *args, **kwargs):
+    # requests response hook, counting every response towards the metrics of the current run
+    metrics.record_response(response, *args, **kwargs)
+
 def set_api_request_strategy():
     logging.info('Setting API Request strategy')
 
     global http
 
+    # Retry connection errors here, throttled and failed responses are retried by the adapter
     retry_strategy = Retry(
         total=3,
-        status_forcelist=[429, 500, 502, 503, 504],
         allowed_methods=['HEAD', 'GET', 'OPTIONS'],
         backoff_factor=10
     )
 
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    # Pace requests from all the workers to stay under the SKY API quota
+    limiter = RateLimiter(rate=RE_API_RATE, max_rate=RE_API_MAX_RATE)
+
+    # Size the connection pool so that every worker can hold a connection
+    adapter = RateLimitedAdapter(limiter, max_retries=retry_strategy, pool_maxsize=max(UNSUBSCRIBE_WORKERS, BOUNCE_WORKERS, 10))
     http = requests.Session()
     http.mount('https://', adapter)
     http.mount('http://', adapter)
 
+    # Count every response towards the metrics of this run
+    http.hooks['response'].append(record_response)
+
 def get_env_variables():
     logging.info('Setting Environment variables')
 
-    global RE_API_KEY, MAIL_USERN, MAIL_PASSWORD, IMAP_URL, IMAP_PORT, SMTP_URL, SMTP_PORT, SEND_TO
+    global AUTH_CODE, RE_API_KEY, RE_API_URL, RE_OAUTH_URL, MAIL_USERN, MAIL_PASSWORD, IMAP_URL, IMAP_PORT, SMTP_URL, SMTP_PORT, SEND_TO
+    global UNSUBSCRIBE_WORKERS, BOUNCE_WORKERS, NETCORE_LOOKBACK_MONTHS, RE_API_RATE, RE_API_MAX_RATE, STATE_STORE
 
     load_dotenv()
 
+    AUTH_CODE = os.getenv('AUTH_CODE')
     RE_API_KEY = os.getenv('RE_API_KEY')
+
+    # Where the SKY API lives, which can be pointed at netcore_sync.mock_sky_api for testing
+    RE_API_URL = os.getenv('RE_API_URL', 'https://api.sky.blackbaud.com')
+    RE_OAUTH_URL = os.getenv('RE_OAUTH_URL', 'https://oauth2.sky.blackbaud.com')
     MAIL_USERN = os.getenv('MAIL_USERN')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     IMAP_URL = os.getenv('IMAP_URL')
@@ -70,9 +122,34 @@ def get_env_variables():
     SMTP_PORT = os.getenv('SMTP_PORT')
     SEND_TO = os.getenv('SEND_TO')
 
+    # No. of consents to post to RE in parallel (1 posts them one after another)
+    UNSUBSCRIBE_WORKERS = int(os.getenv('UNSUBSCRIBE_WORKERS', 1))
+
+    # No. of email addresses to mark inactive in RE in parallel
+    BOUNCE_WORKERS = int(os.getenv('BOUNCE_WORKERS', 1))
+
+    # Only look at Netcore data sent in these many recent months (all of it when not set)
+    NETCORE_LOOKBACK_MONTHS = os.getenv('NETCORE_LOOKBACK_MONTHS')
+
+    # Requests per second to start at and never to go beyond, across all the workers
+    RE_API_RATE = float(os.getenv('RE_API_RATE', DEFAULT_RATE))
+    RE_API_MAX_RATE = float(os.getenv('RE_API_MAX_RATE', DEFAULT_MAX_RATE))
+
+    # Set to 'sqlite' to look up emails and find new events with indexed queries on Databases/Sync State.db
+    STATE_STORE = os.getenv('STATE_STORE', 'parquet').lower()
+
 def send_error_emails(subject):
     logging.info('Sending email for an error')
 
+    # Only needed when something's gone wrong, so they're left out of every other run
+    import imaplib
+    import smtplib
+    import ssl
+    import time
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from jinja2 import Environment
+
     message = MIMEMultipart()
     message["Subject"] = subject
     message["From"] = MAIL_USERN
@@ -167,6 +244,8 @@ def send_error_emails(subject):
         imap.logout()
 
 def attach_file_to_email(message, filename):
+    from email.mime.application import MIMEApplication
+
     # Open the attachment file for reading in binary mode, and make it a MIMEApplication class
     with open(filename, "rb") as f:
         file_attachment = MIMEApplication(f.read())
@@ -180,15 +259,13 @@ def attach_file_to_email(message, filename):
     # Attach the file to the message
     message.attach(file_attachment)
 
-def retrieve_token():
+def set_token_manager():
+    logging.info('Setting up the token manager')
 
-    logging.info('Retrieve token for API connections')
+    global token_manager
 
-    with open('access_token_output.json') as access_token_output:
-        data = json.load(access_token_output)
-        access_token = data['access_token']
-
-    return access_token
+    # Loads the token once and refreshes it shortly before it expires
+    token_manager = TokenManager(http, AUTH_CODE, oauth_url=RE_OAUTH_URL)
 
 def get_request_re(url, params):
     logging.info('Running GET Request from RE function')
@@ -197,12 +274,11 @@ def get_request_re(url, params):
     headers = {
         # Request headers
         'Bb-Api-Subscription-Key': RE_API_KEY,
-        'Authorization': 'Bearer ' + retrieve_token(),
     }
 
     logging.info(params)
 
-    re_api_response = http.get(url, params=params, headers=headers).json()
+    re_api_response = token_manager.request('GET', url, params=params, headers=headers).json()
 
     return re_api_response
 
@@ -212,14 +288,14 @@ def post_request_re(url, params):
     # Request headers
     headers = {
         'Bb-Api-Subscription-Key': RE_API_KEY,
-        'Authorization': 'Bearer ' + retrieve_token(),
         'Content-Type': 'application/json',
     }
 
     logging.info(params)
 
-    re_api_response = http.post(url, params=params, headers=headers, json=params).json()
-    logging.info(re_api_response)
+    # Only in the body, as a combined consent statement is too long for the query string
+    re_api_response = token_manager.request('POST', url, headers=headers, json=params)
+    logging.info(f'{re_api_response.status_code} {re_api_response.text}')
 
     return re_api_response
 
@@ -229,13 +305,13 @@ def patch_request_re(url, params):
     # Request headers
     headers = {
         'Bb-Api-Subscription-Key': RE_API_KEY,
-        'Authorization': 'Bearer ' + retrieve_token(),
         'Content-Type': 'application/json'
     }
 
     logging.info(params)
 
-    re_api_response = http.patch(url, headers=headers, data=json.dumps(params))
+    re_api_response = token_manager.request('PATCH', url, headers=headers, data=json.dumps(params))
+    logging.info(f'{re_api_response.status_code} {re_api_response.text}')
 
     return re_api_response
 
@@ -245,24 +321,73 @@ def load_data(source):
     df = pd.read_parquet(source)
     return df
 
-def get_hard_bounces():
-    logging.info('Getting the list of Hard Bounces')
+def load_email_list():
+    global re_email_list, re_email_index, email_list_fingerprint
 
-    df = netcore[netcore['Bounce Type'] == 'Hard Bounce'][['EMAIL (Primary Key)']].drop_duplicates().reset_index(drop=True)
-    return df
+    # Keep the lookup from the last run (in netcore_sync.daemon) while the list is the same
+    fingerprint = get_fingerprint(EMAIL_LIST)
+
+    if fingerprint == email_list_fingerprint:
+        logging.info('RE Email List is unchanged since the last run')
+        return
+
+    re_email_list = load_data(EMAIL_LIST).copy()
+    re_email_index = build_email_index()
+    email_list_fingerprint = fingerprint
+
+def normalise_email(email):
+    return str(email).strip().lower()
+
+def build_email_index():
+    logging.info('Building lookup of RE IDs by Email Address')
+
+    df = re_email_list.dropna(subset=['address'])[['address', 'constituent_id', 'id']].copy()
+    df['address'] = df['address'].astype(str).str.strip().str.lower()
+
+    # Map each email to its unique RE IDs, in the order they appear in the list
+    index = {}
+    for column in ['constituent_id', 'id']:
+        index[column] = {}
+
+        unique = df.drop_duplicates(['address', column])
+        for address, re_id in zip(unique['address'], unique[column]):
+            index[column].setdefault(address, []).append(re_id)
+
+    # Email addresses already inactive in RE (lists saved before the flag was kept count as active)
+    if 'inactive' in re_email_list.columns:
+        index['inactive'] = set(re_email_list.loc[re_email_list['inactive'].fillna(False).astype(bool), 'id'])
+    else:
+        index['inactive'] = set()
+
+    return index
+
+def lookup_re_ids(email, column):
+    if state_store is not None:
+        return state_store.lookup_re_ids(normalise_email(email), column)
+
+    return re_email_index[column].get(normalise_email(email), [])
+
+def is_inactive(email_address_id):
+    if state_store is not None:
+        return state_store.is_inactive(email_address_id)
 
-def find_remaining_data(all_df, partial_df):
-    logging.info('Identifying missing data between two Panda Dataframes')
+    return email_address_id in re_email_index['inactive']
 
-    # Concatenate dataframes A and B vertically and drop duplicates
-    df = pd.concat([all_df, partial_df]).drop_duplicates(keep=False)
+def get_netcore_months():
+    if NETCORE_LOOKBACK_MONTHS:
+        return recent_months(int(NETCORE_LOOKBACK_MONTHS))
 
-    # df = pd.merge(partial_df, all_df, how='left', indicator=True)
-    # df = df[df['_merge'] == 'left_only']
-    #
-    # # Drop the '_merge' column from the result
-    # df = df.drop('_merge', axis=1)
+def get_hard_bounces():
+    logging.info('Getting the list of Hard Bounces')
 
+    # Read just the hard bounces from Netcore's Data
+    df = read_engagement(
+        columns=['EMAIL (Primary Key)'],
+        row_filter=ds.field('Bounce Type') == 'Hard Bounce',
+        months=get_netcore_months()
+    )
+
+    df = df.drop_duplicates().reset_index(drop=True)
     return df
 
 def identify_hard_bounces():
@@ -270,8 +395,8 @@ def identify_hard_bounces():
 
     # Load Records already uploaded in RE
     if os.path.exists('Databases/Hard Bounces.parquet'):
-        hard_bounces_uploaded = pd.read_parquet('Databases/Hard Bounces.parquet')
-        df = find_remaining_data(hard_bounces, hard_bounces_uploaded).copy()
+        hard_bounces_uploaded = load_history_hashes('Databases/Hard Bounces.parquet', HARD_BOUNCE_KEYS)
+        df = find_new_rows(hard_bounces, hard_bounces_uploaded, HARD_BOUNCE_KEYS)
     else:
         df = hard_bounces.copy()
 
@@ -280,7 +405,14 @@ def identify_hard_bounces():
 def get_unsubscribes():
     logging.info('Getting the list of Unsubscribes')
 
-    df = netcore[~netcore['Unsub reason'].isnull()][['EMAIL (Primary Key)', 'Subject', 'Sent Date', 'Open time', 'Unsub reason']].drop_duplicates().reset_index(drop=True)
+    # Read just the unsubscribes from Netcore's Data
+    df = read_engagement(
+        columns=['EMAIL (Primary Key)', 'Subject', 'Sent Date', 'Open time', 'Unsub reason'],
+        row_filter=ds.field('Unsub reason').is_valid(),
+        months=get_netcore_months()
+    )
+
+    df = df.drop_duplicates().reset_index(drop=True)
     return df
 
 def identify_unsubscribes():
@@ -288,130 +420,361 @@ def identify_unsubscribes():
 
     # Load Records already uploaded in RE
     if os.path.exists('Databases/Unsubscribes.parquet'):
-        unsubscribes_uploaded = pd.read_parquet('Databases/Unsubscribes.parquet')
-        df = pd.concat([unsubscribes_uploaded[['EMAIL (Primary Key)', 'Subject']], unsubscribes[['EMAIL (Primary Key)', 'Subject']]]).drop_duplicates(keep=False)
-        df = pd.merge(left=df, right=unsubscribes, on=['EMAIL (Primary Key)', 'Subject'], how='left')
+        unsubscribes_uploaded = load_history_hashes('Databases/Unsubscribes.parquet', UNSUBSCRIBE_KEYS)
+        df = find_new_rows(unsubscribes, unsubscribes_uploaded, UNSUBSCRIBE_KEYS)
     else:
         df = unsubscribes.copy()
 
+    # One consent per email and subject is enough
+    df = df.drop_duplicates(UNSUBSCRIBE_KEYS).reset_index(drop=True)
+
     return df
 
-def post_unsubscribes_to_re():
-    logging.info('Posting Unsubscribers to RE')
+def run_concurrently(function, items, workers):
+    logging.info(f'Running {len(items)} requests with {workers} worker(s)')
+
+    # Run one after another when concurrency isn't enabled
+    if workers <= 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(function, item): item for item in items}
+        error = None
+
+        # Hand back each result as soon as it's done
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+
+            try:
+                result = future.result()
+            except Exception as e:
+                # Stop sending new requests, but still hand back the ones already done
+                if error is None:
+                    error = e
+                    for pending in futures:
+                        pending.cancel()
+                continue
+
+            yield futures[future], result
+
+        if error is not None:
+            raise error
+
+def append_to_ledger(ledger, row):
+    # Write the record and make sure it's on disk before moving on
+    ledger.write(json.dumps(row, default=str) + '\n')
+    ledger.flush()
+    os.fsync(ledger.fileno())
+
+def compact_ledger(ledger_file, history_file, keys):
+    logging.info(f'Compacting {ledger_file} into {history_file}')
+
+    if not os.path.exists(ledger_file):
+        return
+
+    # Load the records, skipping a partially written last line (if any)
+    records = []
+    with open(ledger_file) as ledger:
+        for line in ledger:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logging.warning(f'Skipping incomplete ledger record: {line}')
+
+    if records:
+        if os.path.exists(history_file):
+            uploaded = with_key_hashes(pd.read_parquet(history_file), keys)
+        else:
+            uploaded = pd.DataFrame()
+
+        records = with_key_hashes(pd.DataFrame(records), keys)
+
+        uploaded = pd.concat([uploaded, records], ignore_index=True)
+        uploaded = uploaded.drop_duplicates().reset_index(drop=True)
+
+        # Swap in the new file in one go, so that a crash never leaves a half written database
+        uploaded.to_parquet(f'{history_file}.tmp')
+        os.replace(f'{history_file}.tmp', history_file)
+
+        # Keep the state store in step with it
+        if state_store is not None:
+            state_store.sync_history()
+
+    os.remove(ledger_file)
+
+def compact_ledgers():
+    # Rows whose writes an earlier run completed, but that it may have crashed before recording (compaction drops
+    # the duplicates of the ones it did record)
+    for kind, ledger_file in [('consent', UNSUBSCRIBES_LEDGER), ('inactive', HARD_BOUNCES_LEDGER)]:
+        rows = write_queue.pop_completed_rows(kind)
+
+        if rows:
+            logging.info(f'Recording {len(rows)} rows completed by an earlier run')
+
+            with open(ledger_file, 'a') as ledger:
+                for row in rows:
+                    append_to_ledger(ledger, row)
+
+    # Fold in uploads recorded by an earlier run that didn't finish
+    compact_ledger(UNSUBSCRIBES_LEDGER, 'Databases/Unsubscribes.parquet', UNSUBSCRIBE_KEYS)
+    compact_ledger(HARD_BOUNCES_LEDGER, 'Databases/Hard Bounces.parquet', HARD_BOUNCE_KEYS)
+
+def set_state_store():
+    logging.info('Setting up the state store')
+
+    global state_store
+
+    state_store = None
+
+    if STATE_STORE == 'sqlite':
+        state_store = StateStore()
+
+def sync_state_store():
+    # Import whatever changed in the Parquet files since the last run (all of them the first time)
+    if state_store is not None:
+        state_store.sync()
+
+def set_checkpoint():
+    logging.info('Checking for an earlier run to resume')
+
+    global checkpoint
+
+    # Picks up the checkpoint left by a run that didn't finish, or starts a new one
+    checkpoint = RunCheckpoint()
+
+def set_input_fingerprint():
+    logging.info('Checking for changes since the last run')
+
+    global input_fingerprint
+
+    # Read afresh every run, so that deleting the file forces a run
+    input_fingerprint = InputFingerprint()
+
+def set_write_queue():
+    logging.info('Setting up the queue of writes to RE')
+
+    global write_queue
+
+    # Picks up the writes left pending by earlier runs
+    write_queue = WriteQueue()
+
+def send_write(item):
+    # Hand back errors instead of raising them, so that one bad record doesn't stop the rest
+    try:
+        if item['method'] == 'POST':
+            return post_request_re(item['url'], item['payload'])
+
+        return patch_request_re(item['url'], item['payload'])
+
+    except requests.RequestException as error:
+        return error
+
+def process_write_queue(kind, workers, ledger_file, history_file, keys):
+    logging.info(f'Sending the queued {kind} writes to RE')
+
+    items = write_queue.due(kind)
+
+    # No. of records in the ledger since it was last compacted
+    ledger_size = 0
+
+    ledger = open(ledger_file, 'a')
+
+    try:
+        for item, re_api_response in run_concurrently(send_write, items, workers):
+
+            # Keep failed writes in the queue (or dead letters), never in the uploaded records
+            if isinstance(re_api_response, Exception):
+                write_queue.fail(item, str(re_api_response))
+
+            elif not re_api_response.ok:
+                write_queue.fail(item, f'{re_api_response.status_code} {re_api_response.text}',
+                                 is_permanent_failure(re_api_response.status_code))
+
+            else:
+                # Update the records of the rows with all their writes through
+                for row in write_queue.complete(item):
+                    append_to_ledger(ledger, row)
+                    ledger_size += 1
+
+                if ledger_size >= LEDGER_COMPACT_EVERY:
+                    ledger.close()
+                    compact_ledger(ledger_file, history_file, keys)
+                    ledger = open(ledger_file, 'a')
+                    ledger_size = 0
+
+    finally:
+        ledger.close()
+
+    # Only now that the rows of the completed writes are recorded, as it drops the writes from the journal
+    write_queue.compact()
+
+    compact_ledger(ledger_file, history_file, keys)
+
+    return len(items)
+
+def combine_consent_statements(statements):
+    # One line per unsubscribe, keeping it to a readable length
+    statement = '\n'.join(statements[:CONSENT_STATEMENT_LINES])
+
+    if len(statements) > CONSENT_STATEMENT_LINES:
+        statement += f'\n... and {len(statements) - CONSENT_STATEMENT_LINES} more'
+
+    return statement
+
+def plan_unsubscribes():
+    logging.info('Queueing the consents to post to RE')
+
+    url = f'{RE_API_URL}/commpref/v1/consent/consents'
+
+    # Unsubscribes of each constituent, so that they get a single consent
+    constituents = {}
+
+    # No. of consents that would have been posted, one per unsubscribe and RE ID
+    events = 0
 
     # Check if there's anything to upload
     if unsubscribes_new.shape[0] != 0:
 
-        # Load Records already uploaded in RE
-        if os.path.exists('Databases/Unsubscribes.parquet'):
-            unsubscribes_uploaded = pd.read_parquet('Databases/Unsubscribes.parquet')
-        else:
-            unsubscribes_uploaded = pd.DataFrame()
+        row_keys = hash_keys(unsubscribes_new, UNSUBSCRIBE_KEYS).astype(str)
 
         # Iterate over rows
-        for index, row in unsubscribes_new.iterrows():
+        for (index, row), row_key in zip(unsubscribes_new.iterrows(), row_keys):
 
-            # Load Object to Dataframe
-            row = pd.DataFrame(row)
-            row = row.T.reset_index(drop=True).copy()
+            # Already queued by an earlier run
+            if write_queue.has_row('consent', row_key):
+                continue
 
             # Get Email Address
-            email = row['EMAIL (Primary Key)'].tolist()[0]
+            email = row['EMAIL (Primary Key)']
 
             # Get date
-            date = row['Open time'].tolist()[0]
+            date = row['Open time']
 
             if pd.isnull(date):
-                date = row['Sent Date'].tolist()[0]
+                date = row['Sent Date']
 
             try:
                 date = pd.to_datetime(date, format='%Y-%m-%d %H:%M:%S')
             except ValueError:
                 date = pd.Timestamp(datetime.now())
 
-            date = date.isoformat()
+            statement = email + ': ' + row['Subject'] + ' | ' + row['Unsub reason']
 
-            # Get RE IDs associated with that email
-            re_ids = re_email_list[re_email_list['address'] == email]['constituent_id'].drop_duplicates().tolist()
+            # Get RE IDs associated with that email, inactive or not, as the unsubscribe is the constituent's whichever
+            # of their addresses it came from
+            re_ids = lookup_re_ids(email, 'constituent_id')
 
             # Loop over each unique RE ID
             for re_id in re_ids:
+                constituent = constituents.setdefault(re_id, {'dates': [], 'statements': [], 'rows': {}})
 
-                # Opt-out
-                params = {
-                    'constituent_id': re_id,
-                    'channel': 'Email',
-                    'category': 'Netcore Email Marketing',
-                    'source': 'Netcore',
-                    'consent_date': date,
-                    'constituent_consent_response': 'OptOut',
-                    'consent_statement': email + ': ' + row['Subject'].tolist()[0] + ' | ' + row['Unsub reason'].tolist()[0]
-                }
+                # Undated unsubscribes (with neither an Open time nor a Sent Date) leave the date to the others
+                if not pd.isnull(date):
+                    constituent['dates'].append(date)
 
-                url = 'https://api.sky.blackbaud.com/commpref/v1/consent/consents'
+                if statement not in constituent['statements']:
+                    constituent['statements'].append(statement)
 
-                # Post Data to RE
-                post_request_re(url, params)
+                # Record of the row for Databases/Unsubscribes.parquet, with the dates as text
+                constituent['rows'][row_key] = row.astype(str).to_dict()
 
-                # Changing the sent date format
-                row['Sent Date'] = row['Sent Date'].astype(str)
-                row['Open time'] = row['Sent Date'].astype(str)
+                events += 1
 
-                # Update the Dataframe
-                unsubscribes_uploaded = pd.concat([unsubscribes_uploaded, row], ignore_index=True)
+    for re_id, constituent in constituents.items():
 
-                # Update Database of one marked as unsubscribed in RE
-                unsubscribes_uploaded.to_parquet('Databases/Unsubscribes.parquet')
+        # Opt-out, as of the latest unsubscribe, or now if none of them are dated
+        consent_date = max(constituent['dates'], default=pd.Timestamp(datetime.now()))
 
-def post_bounces_to_re():
-    logging.info('Marking Inactive Emails in RE')
+        params = {
+            'constituent_id': re_id,
+            'channel': 'Email',
+            'category': 'Netcore Email Marketing',
+            'source': 'Netcore',
+            'consent_date': consent_date.isoformat(),
+            'constituent_consent_response': 'OptOut',
+            'consent_statement': combine_consent_statements(constituent['statements'])
+        }
+
+        write_queue.add('consent', [[row_key, row] for row_key, row in constituent['rows'].items()], 'POST', url,
+                        params)
+
+    logging.info(f'Coalesced {events} unsubscribes into {len(constituents)} consents, '
+                 f'saving {events - len(constituents)} API calls')
+
+    return events - len(constituents)
+
+def post_unsubscribes_to_re():
+    logging.info('Posting Unsubscribers to RE')
+
+    # Post Data to RE, along with anything left from earlier runs
+    return process_write_queue('consent', UNSUBSCRIBE_WORKERS, UNSUBSCRIBES_LEDGER, 'Databases/Unsubscribes.parquet',
+                               UNSUBSCRIBE_KEYS)
+
+def plan_bounces():
+    logging.info('Queueing the email addresses to mark inactive in RE')
+
+    # Mark as Inactive
+    params = {
+        'inactive': True,
+        'primary': False
+    }
+
+    # No. of email addresses already inactive in RE, which need no PATCH
+    skipped = 0
 
     # Check if there's anything to upload
     if hard_bounces_new.shape[0] != 0:
 
-        # Load Records already uploaded in RE
-        if os.path.exists('Databases/Hard Bounces.parquet'):
-            hard_bounces_uploaded = pd.read_parquet('Databases/Hard Bounces.parquet')
-        else:
-            hard_bounces_uploaded = pd.DataFrame()
+        row_keys = hash_keys(hard_bounces_new, HARD_BOUNCE_KEYS).astype(str)
 
-        # Iterate over rows
-        for index, row in hard_bounces_new.iterrows():
+        # Bounces with nothing left to do in RE are recorded as uploaded straight away
+        with open(HARD_BOUNCES_LEDGER, 'a') as ledger:
 
-            # Load Object to DataFrame
-            row = pd.DataFrame(row)
-            row = row.T.reset_index(drop=True).copy()
+            # Iterate over rows
+            for (index, row), row_key in zip(hard_bounces_new.iterrows(), row_keys):
 
-            # Get Email Address
-            email = row['EMAIL (Primary Key)'].tolist()[0]
+                # Already queued by an earlier run
+                if write_queue.has_row('inactive', row_key):
+                    continue
 
-            # Get RE IDs associated with that email
-            email_address_ids = re_email_list[re_email_list['address'] == email]['id'].drop_duplicates().tolist()
+                # Get Email Address
+                email = row['EMAIL (Primary Key)']
 
-            # Loop over each unique Email Address ID
-            for email_address_id in email_address_ids:
+                # Get RE IDs associated with that email
+                email_address_ids = lookup_re_ids(email, 'id')
 
-                # Mark as Inactive
-                params = {
-                    'inactive': True,
-                    'primary': False
-                }
+                # Leave out the ones RE already has as inactive
+                active_ids = [email_address_id for email_address_id in email_address_ids
+                              if not is_inactive(email_address_id)]
 
-                url = f'https://api.sky.blackbaud.com/constituent/v1/emailaddresses/{email_address_id}'
+                skipped += len(email_address_ids) - len(active_ids)
 
-                # Post Data to RE
-                patch_request_re(url, params)
+                if email_address_ids and not active_ids:
+                    append_to_ledger(ledger, row.astype(str).to_dict())
 
-                # Update the Dataframe
-                hard_bounces_uploaded = pd.concat([hard_bounces_uploaded, row], ignore_index=True)
+                # Loop over each unique Email Address ID
+                for email_address_id in active_ids:
+                    write_queue.add('inactive', [[row_key, row.astype(str).to_dict()]], 'PATCH',
+                                    f'{RE_API_URL}/constituent/v1/emailaddresses/{email_address_id}', params)
 
-        # Update Database of one marked as unsubscribed in RE
-        hard_bounces_uploaded.to_parquet('Databases/Hard Bounces.parquet')
+    logging.info(f'Skipped {skipped} email addresses already inactive in RE')
 
-try:
+    return skipped
 
-    # Start Logging for Debugging
-    start_logging()
+def post_bounces_to_re():
+    logging.info('Marking Inactive Emails in RE')
+
+    # Post Data to RE, along with anything left from earlier runs
+    return process_write_queue('inactive', BOUNCE_WORKERS, HARD_BOUNCES_LEDGER, 'Databases/Hard Bounces.parquet',
+                               HARD_BOUNCE_KEYS)
+
+def setup():
+    logging.info('Setting up the session, token and queue kept between runs')
+
+    global is_set_up
 
     # Set current directory
     set_current_directory()
@@ -422,36 +785,145 @@ try:
     # Set API Request strategy
     set_api_request_strategy()
 
-    # Get RE Email List
-    re_email_list = load_data('Databases/Email List.parquet').copy()
+    # Set up the token manager
+    set_token_manager()
+
+    # Load the writes to RE left pending by earlier runs
+    set_write_queue()
+
+    # Open the state store, if enabled
+    set_state_store()
+
+    is_set_up = True
+
+def main():
+    global Argument, re_email_list, re_email_index, unsubscribes, unsubscribes_new, hard_bounces, hard_bounces_new
+
+    try:
+
+        # Start recording metrics
+        start_metrics()
+
+        # Only the first run sets up, later ones (in netcore_sync.daemon) reuse the session, token and queue
+        if not is_set_up:
+            setup()
+
+        # Nothing to do when no input has changed since the last run finished
+        set_input_fingerprint()
+        changes = 'a run was forced' if '--force' in sys.argv else input_fingerprint.get_changes()
+
+        if changes is None:
+            logging.info('Nothing has changed since the last run, skipping this one')
+            metrics.skip()
+            return
+
+        logging.info(f'Running, as {changes}')
+
+        # Fingerprint the data before reading it, so that anything arriving in the meantime is left for the next run
+        input_fingerprint.snapshot_sources()
+
+        # Pick up where an earlier run left off, if it didn't finish
+        set_checkpoint()
+
+        # Writes planned by an earlier run are sent without reading the data again
+        reads_sources = not (checkpoint.is_planned('consent') or checkpoint.is_planned('inactive'))
+
+        # Fold in uploads recorded by an earlier run that didn't finish, before the state store reads them
+        compact_ledgers()
+
+        # Bring the state store up to date with the Parquet files
+        with metrics.stage('sync'):
+            sync_state_store()
 
-    # Load Netcore's Data
-    netcore = load_data('Databases/Netcore Data.parquet').copy()
+        # The RE email list is only needed to plan the writes, and not at all with the state store
+        if state_store is None and not (checkpoint.is_planned('consent') and checkpoint.is_planned('inactive')):
 
-    # Get Unsubscribes
-    unsubscribes = get_unsubscribes().copy()
+            # Get RE Email List, and index RE IDs by email for quick lookups
+            with metrics.stage('load'):
+                load_email_list()
 
-    # Identify Unsubscribes yet to upload in RE
-    unsubscribes_new = identify_unsubscribes().copy()
+            metrics.add_rows('load', re_email_list.shape[0])
 
-    # Upload Unsubscribes data to RE
-    post_unsubscribes_to_re()
+        if not checkpoint.is_planned('consent'):
+            with metrics.stage('diff'):
+                if state_store is not None:
+                    # Indexed query for the Unsubscribes yet to upload in RE
+                    unsubscribes = unsubscribes_new = state_store.find_new_unsubscribes(get_netcore_months())
 
-    # Get Hard Bounces
-    hard_bounces = get_hard_bounces().copy()
+                else:
+                    # Get Unsubscribes
+                    unsubscribes = get_unsubscribes().copy()
 
-    # Identify Bounces yet to upload in RE
-    hard_bounces_new = identify_hard_bounces().copy()
+                    # Identify Unsubscribes yet to upload in RE
+                    unsubscribes_new = identify_unsubscribes().copy()
 
-    # Upload Hard Bounces data to RE
-    post_bounces_to_re()
+                # Queue the consents to post, one per constituent
+                metrics.add_count('consents_coalesced', plan_unsubscribes())
 
-except Exception as Argument:
+            metrics.add_rows('diff', unsubscribes.shape[0])
+            checkpoint.mark_planned('consent')
 
-    logging.error(Argument)
-    send_error_emails('Error while uploading unsubscribes and bounces | Netcore Sync')
+        if not checkpoint.is_completed('consent'):
+            # Upload Unsubscribes data to RE
+            with metrics.stage('post'):
+                metrics.add_rows('post', post_unsubscribes_to_re())
+
+            checkpoint.mark_completed('consent')
+
+        if not checkpoint.is_planned('inactive'):
+            with metrics.stage('diff'):
+                if state_store is not None:
+                    # Indexed query for the Bounces yet to upload in RE
+                    hard_bounces = hard_bounces_new = state_store.find_new_hard_bounces(get_netcore_months())
+
+                else:
+                    # Get Hard Bounces
+                    hard_bounces = get_hard_bounces().copy()
+
+                    # Identify Bounces yet to upload in RE
+                    hard_bounces_new = identify_hard_bounces().copy()
+
+                # Queue the email addresses to mark inactive, leaving out the ones that already are
+                metrics.add_count('already_inactive', plan_bounces())
+
+            metrics.add_rows('diff', hard_bounces.shape[0])
+            checkpoint.mark_planned('inactive')
+
+        if not checkpoint.is_completed('inactive'):
+            # Upload Hard Bounces data to RE
+            with metrics.stage('patch'):
+                metrics.add_rows('patch', post_bounces_to_re())
+
+            checkpoint.mark_completed('inactive')
+
+        # Nothing left to resume
+        checkpoint.finish()
+
+        # For the next run to compare its inputs against, unless this one didn't read them, leaving the next run to
+        if reads_sources:
+            input_fingerprint.save()
+
+        else:
+            logging.info('Resumed an earlier run, leaving any new data to the next one')
+
+    except Exception as Argument:
+
+        logging.error(Argument)
+        metrics.fail(Argument)
+        send_error_emails('Error while uploading unsubscribes and bounces | Netcore Sync')
+
+    finally:
+
+        # Save the metrics of this run
+        metrics.write()
+
+if __name__ == '__main__':
+
+    # Start Logging for Debugging
+    start_logging()
 
-finally:
+    # Run once
+    main()
 
     # Stop Logging
     stop_logging()
@@ -0,0 +1,47 @@
+"""
+Runs any of the scripts from one command, loading only what that script needs, for example:
+
+    python -m netcore_sync refresh-token
+    python -m netcore_sync download-emails --full-refresh
+    python -m netcore_sync upload --force
+
+It does the same as running the script itself, except that an upload with nothing to do stops before the script
+(and pandas with it) is even loaded.
+"""
+import argparse
+
+from netcore_sync.fingerprint import skip_if_unchanged
+from netcore_sync.scripts import load_script, run_script
+
+# Subcommands, and the scripts they run
+COMMANDS = {
+    'refresh-token': 'Refresh Access Token',
+    'download-emails': 'Download Emails from RE',
+    'upload': 'Upload Unsubscribes and Bounces to RE'
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m netcore_sync', description='Syncs Netcore with Raisers Edge')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('refresh-token', help='Refresh the RE access token')
+
+    download = commands.add_parser('download-emails', help='Download the RE email list')
+    download.add_argument('--full-refresh', action='store_true', help='Download every email, not just the changes')
+
+    upload = commands.add_parser('upload', help='Upload unsubscribes and hard bounces to RE')
+    upload.add_argument('--force', action='store_true', help='Run even if nothing has changed since the last run')
+
+    args = parser.parse_args()
+
+    # Most runs have nothing new to upload, which is worth finding out before loading the script
+    if args.command == 'upload' and skip_if_unchanged(COMMANDS['upload'].replace(' ', '_')):
+        return
+
+    # The scripts read their own flags (--full-refresh, --force) from the command line
+    run_script(load_script(COMMANDS[args.command]))
+
+
+if __name__ == '__main__':
+    main()
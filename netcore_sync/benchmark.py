@@ -0,0 +1,295 @@
+"""
+Times each stage of the sync pipeline on synthetic data and records how much memory it needed.
+
+Run from the root of the repo, for example:
+
+    python -m netcore_sync.benchmark --sizes 10000 100000 1000000
+
+Each stage runs in a fresh process, so that its peak memory isn't hidden by the stages before it. Results are
+appended to Logs/Benchmark Results.jsonl, one JSON record per stage and size, so that runs can be compared across
+versions.
+
+With --startup, it times how long each script takes to load in a fresh interpreter instead (the imports and module
+set up every run pays for before doing anything), along with the memory that takes:
+
+    python -m netcore_sync.benchmark --startup --repeats 20
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+from netcore_sync.diff import HARD_BOUNCE_KEYS, UNSUBSCRIBE_KEYS, with_key_hashes
+from netcore_sync.engagement import CHUNK_SIZE, append_engagement, get_engagement_schema
+from netcore_sync.re_export import do_cleanup, do_split
+from netcore_sync.scripts import REPO, load_script
+
+STAGES = ['get_unsubscribes', 'identify_unsubscribes', 'identify_hard_bounces', 'load_from_json_to_parquet',
+          'do_cleanup', 'do_split']
+
+# Scripts timed by --startup, after a bare interpreter to compare them against
+STARTUP_SCRIPTS = [None, 'Refresh Access Token', 'Download Emails from RE', 'Upload Unsubscribes and Bounces to RE']
+
+# Records per page of the RE emailaddresses API
+PAGE_SIZE = 5000
+
+
+def make_email_list(rows, random):
+    constituents = max(rows * 4 // 5, 1)
+
+    return pd.DataFrame({
+        'address': [f'alum{i}@example.com' for i in range(rows)],
+        'constituent_id': random.randint(0, constituents, rows).astype(str),
+        'id': np.arange(rows).astype(str),
+
+        # A few addresses already marked inactive in RE
+        'inactive': random.rand(rows) < 0.02,
+        'primary': True
+    })
+
+
+def make_netcore_data(rows, random):
+    df = pd.DataFrame({column: pd.Series([None] * rows, dtype=object) for column in get_engagement_schema().names})
+
+    df['EMAIL (Primary Key)'] = [f'alum{i}@example.com' for i in random.randint(0, rows, rows)]
+    df['Campaign Name'] = [f'Campaign {i}' for i in random.randint(0, 200, rows)]
+    df['Subject'] = [f'Newsletter {i}' for i in random.randint(0, 200, rows)]
+    df['Sent Date'] = pd.Timestamp('2022-01-01') + pd.to_timedelta(random.randint(0, 730 * 24, rows), unit='h')
+    df['Open time'] = df['Sent Date'] + pd.to_timedelta(random.randint(0, 72, rows), unit='h')
+    df['No. of clicks'] = random.randint(0, 5, rows).astype(str)
+
+    # A few unsubscribes and hard bounces, as in a real campaign
+    events = random.random_sample(rows)
+    df.loc[events < 0.1, 'Unsub reason'] = 'Not interested'
+    df.loc[(events >= 0.1) & (events < 0.15), 'Bounce Type'] = 'Hard Bounce'
+    df.loc[(events >= 0.1) & (events < 0.15), 'Open time'] = pd.NaT
+
+    return df
+
+
+def make_uploaded_history(events, keys):
+    # Half of the events have been uploaded already
+    return with_key_hashes(events.iloc[:len(events) // 2].astype(str), keys)
+
+
+def make_re_export(rows, random):
+    emails = np.where(random.random_sample(rows) < 0.05, 'not-an-email', [f'Alum{i}@Example.com ' for i in range(rows)])
+
+    return pd.DataFrame({
+        'CnBio_Title_1': 'Mr.',
+        'CnBio_First_Name': 'First',
+        'CnBio_Last_Name': 'Last',
+        'CnRelEdu_1_01_Class_of': random.randint(1960, 2024, rows).astype(float),
+        'CnRelEdu_1_01_Degree': 'B.Tech.',
+        'CnRelEdu_1_01_Frat_Sorority': 'Hostel 1',
+        'CnRelEdu_1_01_Maj_1_01_Tableentriesid': 'Department',
+        'CnRelOrg_1_01_Org_Name': 'Organisation',
+        'CnRelOrg_1_01_Position': 'Position',
+        'CnPh_1_01_Phone_number': emails,
+        'CnAdrAdrProc_City': 'Mumbai',
+        'CnAdrAdrProc_State': 'Maharashtra',
+        'CnAdrAdrProc_County': None,
+        'CnAdrAdrProc_Country': 'India',
+        'CnAttrCat_1_01_Description': 'Chapter',
+        'CnAttrCat_3_01_Description': '2000',
+        'CnAttrCat_2_01_Description': None
+    })
+
+
+def write_api_responses(email_list):
+    # Pages as saved by pagination_api_request
+    for i, start in enumerate(range(0, len(email_list), PAGE_SIZE)):
+        page = email_list.iloc[start:start + PAGE_SIZE]
+
+        with open(f'API_Response_RE_Benchmark_{i + 1}.json', 'w') as list_output:
+            json.dump({'count': len(email_list), 'value': page.to_dict('records')}, list_output)
+
+
+def generate_data(directory, rows, seed):
+    print(f'Generating {rows} rows of synthetic data in {directory}')
+
+    os.chdir(directory)
+    os.makedirs('Databases')
+    os.makedirs('Templates')
+
+    with open(os.path.join(REPO, 'Templates', 'Netcore Email Stats.csv')) as source, \
+            open('Templates/Netcore Email Stats.csv', 'w') as template:
+        template.write(source.read())
+
+    random = np.random.RandomState(seed)
+
+    email_list = make_email_list(rows, random)
+    email_list.to_parquet('Databases/Email List.parquet', index=False)
+    write_api_responses(email_list)
+
+    netcore = make_netcore_data(rows, random)
+    known_hashes = {}
+    for start in range(0, rows, CHUNK_SIZE):
+        append_engagement(netcore.iloc[start:start + CHUNK_SIZE], known_hashes)
+
+    unsubscribes = netcore[netcore['Unsub reason'].notna()][['EMAIL (Primary Key)', 'Subject', 'Sent Date',
+                                                               'Open time', 'Unsub reason']]
+    make_uploaded_history(unsubscribes, UNSUBSCRIBE_KEYS).to_parquet('Databases/Unsubscribes.parquet')
+
+    hard_bounces = netcore[netcore['Bounce Type'] == 'Hard Bounce'][['EMAIL (Primary Key)']].drop_duplicates()
+    make_uploaded_history(hard_bounces, HARD_BOUNCE_KEYS).to_parquet('Databases/Hard Bounces.parquet')
+
+    make_re_export(rows, random).to_parquet('RE Export.parquet', index=False)
+
+
+def prepare_stage(stage):
+    # Everything a stage needs before it's timed, returning the call to time
+    if stage in ['get_unsubscribes', 'identify_unsubscribes', 'identify_hard_bounces']:
+        upload = load_script('Upload Unsubscribes and Bounces to RE')
+        upload.NETCORE_LOOKBACK_MONTHS = None
+
+        if stage == 'identify_unsubscribes':
+            upload.unsubscribes = upload.get_unsubscribes()
+
+        if stage == 'identify_hard_bounces':
+            upload.hard_bounces = upload.get_hard_bounces()
+
+        return getattr(upload, stage)
+
+    if stage == 'load_from_json_to_parquet':
+        return load_script('Download Emails from RE').load_from_json_to_parquet
+
+    re_data = pd.read_parquet('RE Export.parquet')
+
+    if stage == 'do_cleanup':
+        return lambda: do_cleanup(re_data)
+
+    cleaned = do_cleanup(re_data)
+    return lambda: do_split(cleaned, 10)
+
+
+def get_peak_rss():
+    # Linux reports it in KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(directory, stage, results):
+    os.chdir(directory)
+    sys.path.insert(0, REPO)
+
+    call = prepare_stage(stage)
+    rss_before = get_peak_rss()
+
+    started = time.perf_counter()
+    call()
+    seconds = time.perf_counter() - started
+
+    results.put({
+        'seconds': round(seconds, 4),
+        'peak_rss_mb': round(get_peak_rss(), 1),
+        'stage_rss_mb': round(get_peak_rss() - rss_before, 1)
+    })
+
+
+def run_startup(script):
+    # Time a fresh interpreter loading the script. Its peak memory comes from /proc, as ru_maxrss starts off at that
+    # of the parent (which has pandas loaded).
+    code = f'from netcore_sync.scripts import load_script; load_script({script!r})' if script else 'pass'
+    code += '; print(open("/proc/self/status").read().split("VmHWM:")[1].split()[0])'
+
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', code], cwd=REPO, capture_output=True, text=True, check=True)
+    seconds = time.perf_counter() - started
+
+    # In KB
+    return seconds, int(process.stdout.split()[-1]) / 1024
+
+
+def time_startup(script, repeats):
+    # Medians, as the first run or two pay for a cold disk cache
+    runs = [run_startup(script) for _ in range(repeats)]
+
+    return {
+        'seconds': round(float(np.median([seconds for seconds, rss in runs])), 4),
+        'peak_rss_mb': round(float(np.median([rss for seconds, rss in runs])), 1)
+    }
+
+
+def get_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Netcore to RE sync pipeline on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help='No. of rows to test with')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to time')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=os.path.join(REPO, 'Logs', 'Benchmark Results.jsonl'))
+    parser.add_argument('--startup', action='store_true', help='Time how long each script takes to load instead')
+    parser.add_argument('--repeats', type=int, default=10, help='No. of times to load each script with --startup')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    version = get_version()
+
+    if args.startup:
+        for script in STARTUP_SCRIPTS:
+            record = {
+                'timestamp': pd.Timestamp.now().isoformat(),
+                'version': version,
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'stage': f'startup: {script or "python"}',
+                'rows': None,
+                **time_startup(script, args.repeats)
+            }
+
+            print(json.dumps(record))
+
+            with open(args.output, 'a') as output:
+                output.write(json.dumps(record) + '\n')
+
+        return
+
+    for rows in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            generate_data(directory, rows, args.seed)
+
+            for stage in args.stages:
+                results = context.Queue()
+                process = context.Process(target=run_stage, args=(directory, stage, results))
+                process.start()
+                process.join()
+
+                if process.exitcode != 0:
+                    raise RuntimeError(f'{stage} failed on {rows} rows')
+
+                result = results.get()
+
+                record = {
+                    'timestamp': pd.Timestamp.now().isoformat(),
+                    'version': version,
+                    'python': platform.python_version(),
+                    'pandas': pd.__version__,
+                    'stage': stage,
+                    'rows': rows,
+                    **result
+                }
+
+                print(json.dumps(record))
+
+                with open(args.output, 'a') as output:
+                    output.write(json.dumps(record) + '\n')
+
+            os.chdir(REPO)
+
+
+if __name__ == '__main__':
+    main()
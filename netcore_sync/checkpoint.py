@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import uuid
+
+from datetime import datetime
+
+# Progress of the current upload run, removed once it finishes
+UPLOAD_CHECKPOINT = 'Databases/Upload Checkpoint.json'
+
+
+class RunCheckpoint:
+    """
+    Which stages of a run have been planned and completed, so that a run that crashed can be resumed by the next one
+    without planning its work all over again.
+
+    The planned work itself lives in the write queue, and the writes completed so far in its journal, so all the
+    checkpoint has to track is how far the run got.
+    """
+
+    def __init__(self, checkpoint_file=UPLOAD_CHECKPOINT):
+        self.checkpoint_file = checkpoint_file
+
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as checkpoint:
+                self.state = json.load(checkpoint)
+
+            self.resumed = True
+            logging.info(f'Resuming run {self.state["run_id"]} started at {self.state["started"]}, '
+                         f'planned: {self.state["planned"]}, completed: {self.state["completed"]}')
+
+        else:
+            self.state = {
+                'run_id': uuid.uuid4().hex,
+                'started': datetime.now().isoformat(),
+                'planned': [],
+                'completed': []
+            }
+
+            self.resumed = False
+            self.save()
+
+    @property
+    def run_id(self):
+        return self.state['run_id']
+
+    def save(self):
+        # Replace the file in one go, so that a crash never leaves a half written checkpoint
+        with open(f'{self.checkpoint_file}.tmp', 'w') as checkpoint:
+            json.dump(self.state, checkpoint, indent=4)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+
+        os.replace(f'{self.checkpoint_file}.tmp', self.checkpoint_file)
+
+    def is_planned(self, stage):
+        return stage in self.state['planned']
+
+    def is_completed(self, stage):
+        return stage in self.state['completed']
+
+    def mark_planned(self, stage):
+        self.state['planned'].append(stage)
+        self.save()
+
+    def mark_completed(self, stage):
+        self.state['completed'].append(stage)
+        self.save()
+
+    def finish(self):
+        logging.info(f'Run {self.run_id} is complete')
+
+        os.remove(self.checkpoint_file)
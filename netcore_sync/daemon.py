@@ -0,0 +1,129 @@
+"""
+Runs the token refresh, email download and upload as one long-running process, instead of a cron job each.
+
+Run from the root of the repo, for example:
+
+    python -m netcore_sync.daemon
+
+Each script is loaded once and then run on a schedule of its own, so the HTTP session, the RE token, the write queue
+and the lookup of RE IDs by email are kept between runs rather than rebuilt by a new interpreter every time. Runs
+never overlap: the scripts take turns, each starting once it's due.
+"""
+import argparse
+import functools
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+from logging.handlers import RotatingFileHandler
+from dotenv import load_dotenv
+from netcore_sync.scripts import load_script, run_script
+
+# Scripts run by the daemon, with the variable setting how often (in minutes) and its default, in the order they
+# first run in
+JOBS = [
+    ('refresh', 'Refresh Access Token', 'DAEMON_REFRESH_MINUTES', 45),
+    ('download', 'Download Emails from RE', 'DAEMON_DOWNLOAD_MINUTES', 60),
+    ('upload', 'Upload Unsubscribes and Bounces to RE', 'DAEMON_UPLOAD_MINUTES', 60)
+]
+
+# Up to these many seconds are added at random to every interval, so that runs drift apart from other jobs on RE
+DEFAULT_JITTER = 60
+
+# When each job ran and how long it took, on top of the logs of the scripts themselves
+DAEMON_LOG = 'Logs/Sync_Daemon.log'
+DAEMON_LOG_MAX_BYTES = 10 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Runs jobs one at a time, each again once its interval (plus some jitter) has passed since it last finished.
+    """
+
+    def __init__(self, jitter=DEFAULT_JITTER):
+        self.jitter = jitter
+        self.jobs = []
+        self.stopping = threading.Event()
+
+    def add(self, name, function, interval):
+        # Every job runs once straight away, in the order they were added
+        self.jobs.append({'name': name, 'function': function, 'interval': interval, 'next_run': time.monotonic()})
+
+    def stop(self, *args):
+        # Signal handler, letting the job that's running finish
+        logger.info('Stopping once the current job is done')
+        self.stopping.set()
+
+    def run(self):
+        while self.jobs and not self.stopping.is_set():
+            job = min(self.jobs, key=lambda job: job['next_run'])
+
+            # Sleep until it's due, waking up early to stop
+            if self.stopping.wait(max(job['next_run'] - time.monotonic(), 0)):
+                break
+
+            logger.info(f'Running {job["name"]}')
+            started = time.monotonic()
+
+            try:
+                job['function']()
+
+            except Exception:
+                # The scripts deal with their own errors, this just makes sure one bad run never stops the others
+                logger.exception(f'{job["name"]} failed')
+
+            finished = time.monotonic()
+            job['next_run'] = finished + job['interval'] + random.uniform(0, self.jitter)
+
+            logger.info(f'{job["name"]} took {finished - started:.1f} seconds, '
+                        f'running again in {job["next_run"] - finished:.0f} seconds')
+
+
+def start_logging():
+    # Kept apart from the logs of the scripts, which start afresh with every run
+    handler = RotatingFileHandler(DAEMON_LOG, maxBytes=DAEMON_LOG_MAX_BYTES, backupCount=1)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the token refresh, email download and upload on a schedule')
+    parser.add_argument('--jobs', nargs='+', choices=[name for name, *_ in JOBS], default=[name for name, *_ in JOBS],
+                        help='Jobs to run (all of them by default)')
+    args = parser.parse_args()
+
+    start_logging()
+    load_dotenv()
+
+    scheduler = Scheduler(jitter=float(os.getenv('DAEMON_JITTER_SECONDS', DEFAULT_JITTER)))
+
+    for name, script_name, variable, default in JOBS:
+        interval = float(os.getenv(variable, default)) * 60
+
+        # An interval of 0 turns the job off, e.g. to leave it to cron
+        if name not in args.jobs or interval <= 0:
+            logger.info(f'Not running {name}')
+            continue
+
+        logger.info(f'Running {name} every {interval / 60:g} minutes')
+        scheduler.add(name, functools.partial(run_script, load_script(script_name)), interval)
+
+    # systemctl stop, or Ctrl+C
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+
+    scheduler.run()
+
+    logger.info('Stopped')
+
+
+if __name__ == '__main__':
+    main()
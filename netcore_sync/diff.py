@@ -0,0 +1,51 @@
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Email column of the Netcore reports, compared case-insensitively
+EMAIL_COLUMN = 'EMAIL (Primary Key)'
+
+# Columns identifying an event that's already been uploaded to RE
+UNSUBSCRIBE_KEYS = [EMAIL_COLUMN, 'Subject']
+HARD_BOUNCE_KEYS = [EMAIL_COLUMN]
+
+# Hash of the key columns, stored alongside the uploaded events so that they needn't be hashed again
+KEY_HASH = 'Key Hash'
+
+
+def hash_keys(df, keys):
+    # Bring the key columns to a common form, so that the hashes match whatever dtype they were stored as
+    key_columns = pd.DataFrame(index=df.index)
+
+    for key in keys:
+        key_columns[key] = df[key].fillna('').astype(str)
+
+        if key == EMAIL_COLUMN:
+            key_columns[key] = key_columns[key].str.strip().str.lower()
+
+    # One 64-bit hash per row
+    return pd.util.hash_pandas_object(key_columns, index=False)
+
+
+def with_key_hashes(df, keys):
+    # Add the hash column to frames saved before it existed
+    if KEY_HASH not in df.columns and df.shape[0] != 0:
+        df = df.copy()
+        df[KEY_HASH] = hash_keys(df, keys)
+
+    return df
+
+
+def load_history_hashes(source, keys):
+    # Read just the hashes of the events already uploaded, working them out for older files
+    if KEY_HASH in pq.read_schema(source).names:
+        return pd.read_parquet(source, columns=[KEY_HASH])[KEY_HASH]
+
+    return hash_keys(pd.read_parquet(source, columns=keys), keys)
+
+
+def find_new_rows(events, history_hashes, keys):
+    # Rows of events whose keys aren't in the history (a left anti-join)
+    if events.shape[0] == 0 or len(history_hashes) == 0:
+        return events.copy()
+
+    return events[~hash_keys(events, keys).isin(pd.unique(history_hashes))].copy()
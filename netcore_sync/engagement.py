@@ -0,0 +1,173 @@
+import os
+import uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from netcore_sync.diff import KEY_HASH, hash_keys
+
+# Netcore engagement data, one folder per month the emails were sent in
+ENGAGEMENT_STORE = 'Databases/Netcore Data'
+
+# Single file the engagement data was kept in before it was partitioned
+LEGACY_ENGAGEMENT_FILE = 'Databases/Netcore Data.parquet'
+
+# Columns of the Netcore reports
+TEMPLATE = 'Templates/Netcore Email Stats.csv'
+DATE_COLUMNS = ['Sent Date', 'Open time']
+
+# Columns the upload script reads, which every report must have
+REQUIRED_COLUMNS = ['EMAIL (Primary Key)', 'Subject', 'Sent Date', 'Open time', 'Bounce Type', 'Unsub reason']
+
+PARTITION = 'month'
+
+# No. of rows of an upload held in memory at a time
+CHUNK_SIZE = 100000
+
+
+def get_engagement_schema():
+    # Every column is kept as text, except for the dates
+    columns = pd.read_csv(TEMPLATE, nrows=0, skipinitialspace=True).columns
+
+    return pa.schema([(column, pa.timestamp('us') if column in DATE_COLUMNS else pa.string()) for column in columns])
+
+
+def to_engagement_frame(df, schema):
+    # Bring an upload to the columns and types of the store
+    df = df.reindex(columns=schema.names)
+
+    for column in schema.names:
+        if column in DATE_COLUMNS:
+            df[column] = pd.to_datetime(df[column])
+        else:
+            df[column] = df[column].astype(object).where(df[column].isna(), df[column].astype(str))
+
+    return df
+
+
+def get_months(sent_dates):
+    return sent_dates.dt.strftime('%Y-%m').fillna('Unknown')
+
+
+def get_file_schema(schema):
+    # Each file also keeps the hash of its rows, so that uploads can be checked against it cheaply
+    return schema.append(pa.field(KEY_HASH, pa.uint64()))
+
+
+def write_partition_file(folder, df, schema):
+    os.makedirs(folder, exist_ok=True)
+
+    name = f'part-{uuid.uuid4().hex}.parquet'
+
+    # Files starting with a dot are skipped by readers, so nobody sees it until it's complete
+    temporary_file = os.path.join(folder, f'.{name}.tmp')
+    pq.write_table(pa.Table.from_pandas(df, schema=get_file_schema(schema), preserve_index=False), temporary_file)
+    os.replace(temporary_file, os.path.join(folder, name))
+
+
+def load_month_hashes(folder, schema):
+    if not os.path.isdir(folder):
+        return np.array([], dtype=np.uint64)
+
+    dataset = ds.dataset(folder, format='parquet', schema=get_file_schema(schema))
+    hashes = dataset.to_table(columns=[KEY_HASH]).column(KEY_HASH)
+
+    # Files written before the hashes were kept have to be read in full
+    if hashes.null_count:
+        return hash_keys(dataset.to_table(columns=schema.names).to_pandas(), schema.names).to_numpy()
+
+    return hashes.to_numpy()
+
+
+def append_engagement(df, known_hashes=None):
+    # Hashes of the rows already in each month, shared between chunks of the same upload
+    if known_hashes is None:
+        known_hashes = {}
+
+    schema = get_engagement_schema()
+
+    df = to_engagement_frame(df, schema).drop_duplicates()
+    df[KEY_HASH] = hash_keys(df, schema.names)
+
+    added = 0
+
+    for month, rows in df.groupby(get_months(df['Sent Date'])):
+        folder = os.path.join(ENGAGEMENT_STORE, f'{PARTITION}={month}')
+
+        if month not in known_hashes:
+            known_hashes[month] = load_month_hashes(folder, schema)
+
+        # Only add rows that aren't already in that month
+        rows = rows[~rows[KEY_HASH].isin(known_hashes[month])]
+
+        if rows.shape[0] == 0:
+            continue
+
+        write_partition_file(folder, rows, schema)
+        known_hashes[month] = np.concatenate([known_hashes[month], rows[KEY_HASH].to_numpy(dtype=np.uint64)])
+        added += rows.shape[0]
+
+    return added
+
+
+def check_upload(source):
+    # Headers are matched without the spaces around them, as in the template (", " between columns)
+    header = pd.read_csv(source, nrows=0, skipinitialspace=True).columns.str.strip()
+
+    # Back to the start of an uploaded file, for it to be read in full
+    if hasattr(source, 'seek'):
+        source.seek(0)
+
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        raise ValueError(f'{getattr(source, "name", source)} is missing the columns: {", ".join(missing)}')
+
+
+def read_upload(source):
+    # Read a Netcore report a chunk at a time, keeping just the columns of the template as text
+    columns = get_engagement_schema().names
+
+    check_upload(source)
+
+    # Laid out like the template, the values have a space after the comma too
+    for df in pd.read_csv(source, chunksize=CHUNK_SIZE, usecols=lambda column: column.strip() in columns, dtype=str,
+                          skipinitialspace=True):
+        df.columns = df.columns.str.strip()
+        yield df
+
+
+def migrate_legacy_engagement():
+    # Move the single file of engagement data into the partitioned store
+    if os.path.exists(LEGACY_ENGAGEMENT_FILE) and not os.path.isdir(ENGAGEMENT_STORE):
+        known_hashes = {}
+
+        for batch in pq.ParquetFile(LEGACY_ENGAGEMENT_FILE).iter_batches(batch_size=CHUNK_SIZE):
+            append_engagement(batch.to_pandas(), known_hashes)
+
+        os.replace(LEGACY_ENGAGEMENT_FILE, f'{LEGACY_ENGAGEMENT_FILE}.migrated')
+
+
+def recent_months(count):
+    # This month and the ones before it, plus emails with no sent date
+    this_month = pd.Timestamp.now().to_period('M')
+
+    return [str(this_month - i) for i in range(count)] + ['Unknown']
+
+
+def read_engagement(columns=None, row_filter=None, months=None):
+    # Fall back to the single file, until the first upload moves it into the store
+    if not os.path.isdir(ENGAGEMENT_STORE):
+        return pq.read_table(LEGACY_ENGAGEMENT_FILE, columns=columns, filters=row_filter).to_pandas()
+
+    partitioning = ds.partitioning(pa.schema([(PARTITION, pa.string())]), flavor='hive')
+    dataset = ds.dataset(ENGAGEMENT_STORE, format='parquet', partitioning=partitioning,
+                         schema=get_file_schema(get_engagement_schema()).append(pa.field(PARTITION, pa.string())))
+
+    # Only the folders of the months asked for are read
+    if months is not None:
+        month_filter = ds.field(PARTITION).isin(months)
+        row_filter = month_filter if row_filter is None else row_filter & month_filter
+
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
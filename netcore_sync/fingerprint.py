@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+from netcore_sync.checkpoint import UPLOAD_CHECKPOINT
+from netcore_sync.metrics import Metrics
+
+# Fingerprint of the inputs of the last upload run that finished
+UPLOAD_FINGERPRINT = 'Databases/Upload Fingerprint.json'
+
+# Only the standard library is used here, so that a run with nothing to do finds out without importing pandas. The
+# paths are those of netcore_sync.engagement, netcore_sync.write_queue and the upload script.
+
+# New data to upload, and RE emails to match it to, fingerprinted as the run starts
+SOURCES = ['Databases/Email List.parquet', 'Databases/Netcore Data.parquet']
+SOURCE_FOLDERS = ['Databases/Netcore Data']
+
+# Records of what's been done, changed by the run itself (or by hand, e.g. to retry dead letters), fingerprinted as
+# it finishes
+RECORDS = ['Databases/Unsubscribes.parquet', 'Databases/Hard Bounces.parquet', 'Databases/Dead Letters.parquet']
+
+# Signs of work left over: uploads not yet folded into the records, and a run that didn't finish
+LEDGERS = ['Databases/Unsubscribes Ledger.jsonl', 'Databases/Hard Bounces Ledger.jsonl']
+WRITE_QUEUE = 'Databases/Write Queue.jsonl'
+
+# Settings that change what the run would do with the same files
+SETTINGS = ['NETCORE_LOOKBACK_MONTHS']
+
+# Bytes of a file read at a time to hash it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+
+    # A chunk at a time, as hashlib.file_digest needs Python 3.11
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def get_source_paths():
+    paths = [path for path in SOURCES if os.path.exists(path)]
+
+    for folder in SOURCE_FOLDERS:
+        for root, folders, files in os.walk(folder):
+            paths.extend(os.path.join(root, file) for file in files if file.endswith('.parquet'))
+
+    return sorted(paths)
+
+
+def get_record_paths():
+    return sorted(path for path in RECORDS if os.path.exists(path))
+
+
+def get_next_write(queue_file=WRITE_QUEUE):
+    # When the next write in the queue is due, replaying the journal as netcore_sync.write_queue does
+    next_attempts = {}
+
+    if os.path.exists(queue_file):
+        with open(queue_file) as journal:
+            for line in journal:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+                if event['event'] in ['queued', 'failed']:
+                    next_attempts[event['item']['key']] = event['item']['next_attempt']
+                else:
+                    next_attempts.pop(event['item']['key'], None)
+
+    return min(next_attempts.values(), default=None)
+
+
+class InputFingerprint:
+    """
+    Size, modification time and content hash of every file an upload run reads, so that a run can tell that nothing
+    has changed since the last one finished, and stop straight away.
+
+    Files are only hashed when their size and modification time no longer match, so that a file that's rewritten
+    with the same content (like the email list by every download) still counts as unchanged.
+    """
+
+    def __init__(self, fingerprint_file=UPLOAD_FINGERPRINT):
+        self.fingerprint_file = fingerprint_file
+        self.sources = None
+
+        if os.path.exists(self.fingerprint_file):
+            with open(self.fingerprint_file) as fingerprint:
+                self.last = json.load(fingerprint)
+        else:
+            self.last = None
+
+    def get_file(self, path, last=None):
+        stat = os.stat(path)
+
+        # The hash from last time holds, as long as the file hasn't been touched since
+        if last is not None and last['size'] == stat.st_size and last['mtime_ns'] == stat.st_mtime_ns:
+            return last
+
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': hash_file(path)}
+
+    def is_same(self, paths, last):
+        if sorted(last) != paths:
+            return False
+
+        for path in paths:
+            # A different size is a different file, no need to hash it
+            if os.stat(path).st_size != last[path]['size']:
+                return False
+
+            if self.get_file(path, last[path])['sha256'] != last[path]['sha256']:
+                return False
+
+        return True
+
+    def get_settings(self):
+        return {setting: os.getenv(setting) for setting in SETTINGS}
+
+    def get_pending_work(self):
+        # Anything left over that needs a run, whatever the files say
+        if os.path.exists(UPLOAD_CHECKPOINT):
+            return 'an earlier run did not finish'
+
+        if any(os.path.exists(ledger) and os.path.getsize(ledger) for ledger in LEDGERS):
+            return 'uploads are yet to be recorded'
+
+        next_write = get_next_write()
+        if next_write is not None and next_write <= time.time():
+            return 'writes to RE are due to be tried again'
+
+    def get_changes(self):
+        # Why a run is needed, or None if nothing has changed since the last one finished
+        if self.last is None:
+            return 'no earlier run has finished'
+
+        pending_work = self.get_pending_work()
+        if pending_work:
+            return pending_work
+
+        if self.get_settings() != self.last['settings']:
+            return 'settings have changed'
+
+        if not self.is_same(get_source_paths(), self.last['sources']):
+            return 'new data to upload'
+
+        if not self.is_same(get_record_paths(), self.last['records']):
+            return 'records of uploads have changed'
+
+    def snapshot_sources(self):
+        # Taken before the run reads them, so that data arriving during the run is picked up by the next one
+        last = self.last['sources'] if self.last is not None else {}
+        self.sources = {path: self.get_file(path, last.get(path)) for path in get_source_paths()}
+
+    def save(self):
+        last = self.last['records'] if self.last is not None else {}
+
+        fingerprint = {
+            'saved': time.time(),
+            'settings': self.get_settings(),
+            'sources': self.sources,
+            'records': {path: self.get_file(path, last.get(path)) for path in get_record_paths()}
+        }
+
+        # Replace the file in one go, so that a crash never leaves a half written fingerprint
+        with open(f'{self.fingerprint_file}.tmp', 'w') as fingerprint_output:
+            json.dump(fingerprint, fingerprint_output, indent=4)
+
+        os.replace(f'{self.fingerprint_file}.tmp', self.fingerprint_file)
+
+        self.last = fingerprint
+
+
+def skip_if_unchanged(process_name):
+    # Whether an upload run can stop straight away, recording it in the metrics (but keeping the log of the last run
+    # that did something) if so
+    if '--force' in sys.argv:
+        return False
+
+    load_dotenv()
+
+    if InputFingerprint().get_changes() is not None:
+        return False
+
+    metrics = Metrics(process_name)
+    metrics.skip()
+    metrics.write()
+
+    return True
@@ -0,0 +1,114 @@
+import json
+import os
+import re
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlparse
+
+# One JSON record per run of each script
+METRICS_FILE = 'Logs/Metrics.jsonl'
+
+# Roll the file over to Metrics.jsonl.1 once it gets this big
+METRICS_MAX_BYTES = 10 * 1024 * 1024
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+def get_endpoint(url):
+    # Replace IDs in the path, so that requests for different records count towards the same endpoint
+    path = urlparse(url).path
+    return re.sub(r'/(\d+|[0-9a-fA-F-]{32,36})(?=/|$)', '/{id}', path)
+
+
+class Metrics:
+    """
+    Collects stage durations, rows processed and per-endpoint request statistics for a run of a script, and
+    appends them to Logs/Metrics.jsonl when the run ends.
+    """
+
+    def __init__(self, process_name, metrics_file=METRICS_FILE):
+        self.process_name = process_name
+        self.metrics_file = metrics_file
+        self.started = time.time()
+        self.status = 'success'
+        self.error = None
+        self.stages = {}
+        self.counts = Counter()
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.stages.setdefault(name, {'seconds': 0, 'rows': 0})
+            self.stages[name]['seconds'] += round(time.perf_counter() - started, 4)
+
+    def add_rows(self, name, rows):
+        self.stages.setdefault(name, {'seconds': 0, 'rows': 0})
+        self.stages[name]['rows'] += int(rows)
+
+    def add_count(self, name, count):
+        # Anything else worth keeping an eye on, like the API calls saved
+        self.counts[name] += int(count)
+
+    def record_request(self, method, url, status, seconds):
+        endpoint = f'{method} {get_endpoint(url)}'
+
+        with self.lock:
+            stats = self.requests.setdefault(endpoint, {
+                'count': 0,
+                'seconds': 0,
+                'statuses': Counter(),
+                'latency': Counter()
+            })
+
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['statuses'][str(status)] += 1
+
+            # Count the request under the first bucket it fits in
+            bucket = next((f'<={bound}' for bound in LATENCY_BUCKETS if seconds <= bound), f'>{LATENCY_BUCKETS[-1]}')
+            stats['latency'][bucket] += 1
+
+    def record_response(self, response, *args, **kwargs):
+        # requests response hook
+        self.record_request(response.request.method, response.url, response.status_code,
+                            response.elapsed.total_seconds())
+
+    def skip(self):
+        # The run had nothing to do
+        self.status = 'skipped'
+
+    def fail(self, error):
+        self.status = 'failed'
+        self.error = str(error)
+
+    def write(self):
+        record = {
+            'timestamp': datetime.now().isoformat(),
+            'script': self.process_name,
+            'status': self.status,
+            'error': self.error,
+            'seconds': round(time.time() - self.started, 4),
+            'stages': self.stages,
+            'counts': self.counts,
+            'requests': {
+                endpoint: {**stats, 'seconds': round(stats['seconds'], 4)} for endpoint, stats in self.requests.items()
+            }
+        }
+
+        # Keep one older file around once this one gets too big
+        if os.path.exists(self.metrics_file) and os.path.getsize(self.metrics_file) > METRICS_MAX_BYTES:
+            os.replace(self.metrics_file, f'{self.metrics_file}.1')
+
+        with open(self.metrics_file, 'a') as metrics_output:
+            metrics_output.write(json.dumps(record) + '\n')
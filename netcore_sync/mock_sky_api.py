@@ -0,0 +1,232 @@
+"""
+Local stand-in for the parts of the SKY API used by the sync scripts, for load testing them offline.
+
+Start it with, for example:
+
+    python -m netcore_sync.mock_sky_api --port 8080 --emails 50000 --latency 0.2 --quota 600 --error-rate 0.01
+
+and point the scripts at it by setting RE_API_URL and RE_OAUTH_URL to http://localhost:8080 in the .env file.
+Request counts by endpoint and status are served at /_stats.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# Longest URL the gateway in front of the API accepts
+MAX_URL_LENGTH = 2048
+
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.window_started = time.time()
+        self.window_requests = 0
+        self.burst_remaining = 0
+        self.tokens = {}
+        self.stats = Counter()
+
+        # Synthetic RE email addresses
+        self.emails = [
+            {
+                'id': str(i),
+                'address': f'alum{i}@example.com',
+                'constituent_id': str(i % max(args.emails * 4 // 5, 1)),
+                'inactive': i % 50 == 0,
+                'primary': True,
+                'date_modified': '2024-01-01T00:00:00+00:00'
+            }
+            for i in range(args.emails)
+        ]
+
+    def take_quota(self):
+        # Seconds to wait before the next request is allowed, or 0 if it can go ahead
+        with self.lock:
+            now = time.time()
+
+            if now - self.window_started >= 60:
+                self.window_started = now
+                self.window_requests = 0
+
+            if self.args.quota and self.window_requests >= self.args.quota:
+                return max(1, int(self.window_started + 60 - now) + 1)
+
+            self.window_requests += 1
+            return 0
+
+    def quota_headers(self):
+        if not self.args.quota:
+            return {}
+
+        with self.lock:
+            return {
+                'RateLimit-Limit': str(self.args.quota),
+                'RateLimit-Remaining': str(max(self.args.quota - self.window_requests, 0)),
+                'RateLimit-Reset': str(max(int(self.window_started + 60 - time.time()), 0))
+            }
+
+    def in_error_burst(self):
+        # Start a burst of server errors every now and then
+        with self.lock:
+            if self.burst_remaining == 0 and random.random() < self.args.error_rate:
+                self.burst_remaining = self.args.burst_length
+
+            if self.burst_remaining:
+                self.burst_remaining -= 1
+                return True
+
+            return False
+
+    def issue_token(self):
+        access_token = uuid.uuid4().hex
+
+        with self.lock:
+            self.tokens[access_token] = time.time() + self.args.token_lifetime
+
+        return {
+            'access_token': access_token,
+            'refresh_token': uuid.uuid4().hex,
+            'expires_in': self.args.token_lifetime,
+            'token_type': 'bearer'
+        }
+
+    def is_authorised(self, authorization):
+        access_token = (authorization or '').replace('Bearer ', '')
+
+        with self.lock:
+            return self.tokens.get(access_token, 0) > time.time()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+
+        for name, value in {**self.state.quota_headers(), **(headers or {})}.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(content)
+
+        self.state.stats[f'{self.command} {self.endpoint} {status}'] += 1
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        self.endpoint = re.sub(r'/emailaddresses/[^/]+$', '/emailaddresses/{id}', url.path)
+        body = self.read_body()
+
+        if url.path == '/_stats':
+            return self.send_json(200, dict(self.state.stats))
+
+        if len(self.path) > MAX_URL_LENGTH:
+            return self.send_json(414, {'message': 'The request URL is too long.'})
+
+        # Latency of the real API, with a little jitter
+        if self.state.args.latency:
+            time.sleep(self.state.args.latency * random.uniform(0.5, 1.5))
+
+        retry_after = self.state.take_quota()
+        if retry_after:
+            return self.send_json(429, {
+                'statusCode': 429,
+                'message': f'Rate limit is exceeded. Try again in {retry_after} seconds.'
+            }, {'Retry-After': str(retry_after)})
+
+        if self.state.in_error_burst():
+            return self.send_json(503, {'message': 'Service unavailable'})
+
+        if self.command == 'POST' and url.path == '/token':
+            return self.send_json(200, self.state.issue_token())
+
+        if not self.state.is_authorised(self.headers.get('Authorization')):
+            return self.send_json(401, {'statusCode': 401, 'message': 'Access token is missing or invalid.'})
+
+        if self.command == 'GET' and url.path == '/constituent/v1/emailaddresses':
+            return self.list_emails(parse_qs(url.query))
+
+        if self.command in ['POST', 'PATCH'] and random.random() < self.state.args.reject_rate:
+            return self.send_json(400, {'message': 'The request is invalid.'})
+
+        if self.command == 'POST' and url.path == '/commpref/v1/consent/consents':
+            json.loads(body)
+            return self.send_json(200, {'id': uuid.uuid4().hex})
+
+        if self.command == 'PATCH' and self.endpoint == '/constituent/v1/emailaddresses/{id}':
+            json.loads(body)
+            return self.send_json(200, {})
+
+        return self.send_json(404, {'message': 'Resource not found'})
+
+    def list_emails(self, query):
+        limit = int(query.get('limit', ['500'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+        emails = self.state.emails
+
+        # Like the real API, inactive emails are only listed when asked for
+        if query.get('include_inactive', ['false'])[0].lower() != 'true':
+            emails = [email for email in emails if not email['inactive']]
+
+        if 'last_modified' in query:
+            emails = [email for email in emails if email['date_modified'] >= query['last_modified'][0]]
+
+        page = {'count': len(emails), 'value': emails[offset:offset + limit]}
+
+        if offset + limit < len(emails):
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query['offset'] = offset + limit
+            page['next_link'] = f'http://{self.headers["Host"]}/constituent/v1/emailaddresses?{urlencode(next_query)}'
+
+        return self.send_json(200, page)
+
+    do_GET = do_POST = do_PATCH = handle_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the SKY API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--emails', type=int, default=10000, help='No. of RE email addresses to serve')
+    parser.add_argument('--latency', type=float, default=0, help='Average seconds to take over each request')
+    parser.add_argument('--quota', type=int, default=0, help='Requests allowed per minute (0 for no limit)')
+    parser.add_argument('--error-rate', type=float, default=0, help='Chance of a request starting a burst of 503s')
+    parser.add_argument('--burst-length', type=int, default=5, help='No. of 503s in a row once a burst starts')
+    parser.add_argument('--reject-rate', type=float, default=0, help='Chance of a write being rejected with a 400')
+    parser.add_argument('--token-lifetime', type=int, default=3600, help='Seconds an access token is valid for')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    MockHandler.state = MockState(args)
+
+    server = ThreadingHTTPServer(('localhost', args.port), MockHandler)
+    print(f'Mock SKY API listening on http://localhost:{args.port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(dict(MockHandler.state.stats), indent=4, sort_keys=True))
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import logging
+import random
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from requests.hooks import dispatch_hook
+
+# Requests per second to start at, and never to go beyond
+DEFAULT_RATE = 5
+DEFAULT_MAX_RATE = 10
+
+# Never slow down below one request every 10 seconds
+MIN_RATE = 0.1
+
+# AIMD: speed up a little after every success, halve the rate when throttled
+ADDITIVE_INCREASE = 0.05
+MULTIPLICATIVE_DECREASE = 0.5
+
+# Stay this far under the quota advertised in the RateLimit headers
+QUOTA_HEADROOM = 0.9
+
+# Responses worth trying again. POSTs are only retried when RE is sure to have turned them away, so that a
+# consent is never posted twice.
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+RETRY_STATUSES_POST = [429, 503]
+
+# Backoff (in seconds) when RE doesn't say how long to wait
+BACKOFF_BASE = 2
+BACKOFF_MAX = 120
+
+
+def parse_retry_after(value):
+    # Either a number of seconds or an HTTP date
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_header(headers, name):
+    return headers.get(name, headers.get(f'X-{name}'))
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request of a process, so that all the worker threads together stay under the
+    SKY API quota.
+
+    The rate adapts to how RE responds: it creeps up with every success and halves whenever RE throttles us, so it
+    settles just under the quota. A Retry-After pauses every thread, not just the one that was throttled.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, max_rate=DEFAULT_MAX_RATE, burst=1):
+        self.max_rate = max(float(max_rate), MIN_RATE)
+        self.rate = min(max(float(rate), MIN_RATE), self.max_rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.quota_rate = None
+        self.decreased_at = 0
+        self.lock = threading.Lock()
+
+    def get_rate(self):
+        if self.quota_rate is not None:
+            return max(min(self.rate, self.quota_rate), MIN_RATE)
+
+        return self.rate
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+
+            # Top up the bucket for the time gone by, and take a token (going into debt if there's none left)
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.get_rate())
+            self.updated = now
+            self.tokens -= 1
+
+            wait = max(-self.tokens / self.get_rate(), self.paused_until - now, 0)
+
+        if wait:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.rate + ADDITIVE_INCREASE, self.max_rate)
+
+    def on_throttled(self):
+        with self.lock:
+            # Requests already in flight get throttled together, which should only count once
+            if time.monotonic() - self.decreased_at < 1:
+                return
+
+            self.rate = max(self.rate * MULTIPLICATIVE_DECREASE, MIN_RATE)
+            self.decreased_at = time.monotonic()
+
+        logging.warning(f'RE is throttling requests, slowing down to {self.rate:.2f} requests per second')
+
+    def observe_quota(self, headers):
+        # Spread what's left of the quota over the time until it resets
+        remaining = get_header(headers, 'RateLimit-Remaining')
+        reset = get_header(headers, 'RateLimit-Reset')
+
+        if remaining is None or reset is None:
+            return
+
+        try:
+            remaining = float(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+
+        if remaining <= 0:
+            self.pause(reset)
+
+        with self.lock:
+            self.quota_rate = QUOTA_HEADROOM * remaining / reset if reset > 0 else None
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    Sends every request through a RateLimiter, and retries the ones RE throttled or failed to handle, honouring
+    Retry-After. Unlike urllib3's Retry, this also retries POST and PATCH requests.
+    """
+
+    def __init__(self, limiter=None, retries=5, **kwargs):
+        self.limiter = limiter or RateLimiter()
+        self.retries = retries
+        super().__init__(**kwargs)
+
+    def should_retry(self, request, response):
+        if request.method == 'POST':
+            return response.status_code in RETRY_STATUSES_POST
+
+        return response.status_code in RETRY_STATUSES
+
+    def send(self, request, **kwargs):
+        attempt = 0
+
+        while True:
+            self.limiter.acquire()
+
+            started = time.perf_counter()
+            response = super().send(request, **kwargs)
+            response.elapsed = timedelta(seconds=time.perf_counter() - started)
+
+            self.limiter.observe_quota(response.headers)
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+            # A 503 is only about load when RE says when to come back, otherwise it's just an outage
+            if response.status_code == 429 or (response.status_code == 503 and retry_after is not None):
+                self.limiter.on_throttled()
+            elif response.status_code < 500:
+                self.limiter.on_success()
+
+            if not self.should_retry(request, response) or attempt == self.retries:
+                return response
+
+            attempt += 1
+
+            if retry_after is not None:
+                # Hold back every thread, as they'd all be turned away
+                self.limiter.pause(retry_after)
+            else:
+                time.sleep(min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1))
+
+            logging.info(f'{request.method} {request.url} returned {response.status_code}, trying again '
+                         f'({attempt} of {self.retries})')
+
+            # The session only sees the last response, so let its hooks (e.g. metrics) know about this one
+            dispatch_hook('response', request.hooks, response)
+            response.close()
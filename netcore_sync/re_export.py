@@ -0,0 +1,130 @@
+import io
+import zipfile
+import numpy as np
+
+# Pattern of a valid email, applied to a whole column at once
+EMAIL_REGEX = r'^[a-zA-Z0-9.!#$%&’*+/=?^_`{|}~-]+@[a-zA-Z0-9-]+(?:\.[a-zA-Z]{2,})+$'
+
+
+def sanitise_emails(emails):
+    """
+    Removes non-ASCII characters and surrounding whitespace from a column of emails, and blanks the invalid ones.
+
+    Args:
+        emails (pd.Series): The emails to sanitise.
+
+    Returns:
+        pd.Series: The emails without non-ASCII characters or surrounding whitespace, with invalid ones set to NaN.
+    """
+    emails = emails.str.replace(r'[^\x00-\x7f]+', '', regex=True).str.strip()
+
+    return emails.where(emails.str.match(EMAIL_REGEX, na=False))
+
+
+def do_cleanup(re_data):
+
+    ### Rename columns
+    re_data = re_data.rename(
+        columns={
+            'CnBio_Title_1': 'TITLE',
+            'CnBio_First_Name': 'FIRST_NAME',
+            'CnBio_Last_Name': 'LAST_NAME',
+            'CnRelEdu_1_01_Class_of': 'CLASS_OF',
+            'CnRelEdu_1_01_Degree': 'DEGREE',
+            'CnRelEdu_1_01_Frat_Sorority': 'HOSTEL',
+            'CnRelEdu_1_01_Maj_1_01_Tableentriesid': 'DEPARTMENT',
+            'CnRelOrg_1_01_Org_Name': 'ORGANIZATION_NAME',
+            'CnRelOrg_1_01_Position': 'POSITION',
+            'CnPh_1_01_Phone_number': 'EMAIL',
+            'CnAdrAdrProc_City': 'CITY',
+            'CnAdrAdrProc_State': 'STATE_1',
+            'CnAdrAdrProc_County': 'STATE_2',
+            'CnAdrAdrProc_Country': 'COUNTRY',
+            'CnAttrCat_1_01_Description': 'CHAPTER',
+            'CnAttrCat_3_01_Description': 'REUNION_YEAR',
+            'CnAttrCat_2_01_Description': 'AWARDS'
+        }
+    )
+
+    ### Convert 'Class of' from FLOAT to INT
+    re_data['CLASS_OF'] = re_data['CLASS_OF'].fillna(0)
+    re_data['CLASS_OF'] = re_data['CLASS_OF'].astype(int)
+
+    ### Remove incorrect organisations
+    re_data['ORGANIZATION_NAME'] = re_data['ORGANIZATION_NAME'].replace('add-company', np.nan)
+
+    ### Get rid of records with no emails
+    re_data = re_data.dropna(subset=['EMAIL']).copy()
+
+    ### Get proper state
+    re_data['STATE'] = re_data['STATE_1'].fillna('').astype(str) + ' ' + re_data['STATE_2'].fillna('').astype(str)
+    re_data = re_data.drop(columns=['STATE_1', 'STATE_2']).copy()
+
+    ### Remove Unknown chapters
+    re_data['CHAPTER'] = re_data['CHAPTER'].replace('Unknown', np.nan)
+
+    re_data = re_data[['EMAIL', 'TITLE', 'FIRST_NAME', 'LAST_NAME', 'CLASS_OF', 'DEGREE', 'HOSTEL',
+                       'DEPARTMENT', 'ORGANIZATION_NAME', 'POSITION', 'CITY', 'STATE', 'COUNTRY', 'CHAPTER',
+                       'AWARDS']].copy()
+
+    ### Check for Duplicate emails
+    re_data = re_data.drop_duplicates('EMAIL').copy()
+
+    ### Remove non-ASCII characters from email and invalid emails
+    re_data['EMAIL'] = sanitise_emails(re_data['EMAIL'])
+    re_data = re_data.dropna(subset=['EMAIL']).copy()
+
+    ### Remove IITB emails
+    re_data = re_data[~(re_data['EMAIL'].str.contains('@iitb.ac.in'))].copy()
+
+    ### Final Cleanup
+    re_data = re_data.dropna(subset=['EMAIL']).copy()
+    re_data = re_data.drop_duplicates('EMAIL').copy()
+
+    return re_data
+
+
+def get_split_boundaries(sizes, num_splits):
+    # Fill each split up to its share of the rows, without breaking up any group
+    total = sum(sizes)
+    boundaries = []
+    rows = 0
+
+    for i, size in enumerate(sizes):
+        rows += size
+
+        if rows * num_splits >= total * (len(boundaries) + 1) and len(boundaries) < num_splits - 1:
+            boundaries.append(i + 1)
+
+    return boundaries
+
+
+def split_data(re_data, num_splits, keep_class_together=False):
+    ### Sorting
+    re_data = re_data.sort_values(by=['CLASS_OF'], kind='stable')
+
+    num_splits = max(1, min(num_splits, len(re_data)))
+
+    if keep_class_together:
+        # Cut only between classes
+        class_sizes = re_data.groupby('CLASS_OF', sort=True).size().tolist()
+        class_ends = np.cumsum(class_sizes)
+        cuts = [0] + [class_ends[i - 1] for i in get_split_boundaries(class_sizes, num_splits)] + [len(re_data)]
+    else:
+        # Split sizes differ by one row at most
+        cuts = [len(re_data) * i // num_splits for i in range(num_splits + 1)]
+
+    return [re_data.iloc[start:end] for start, end in zip(cuts, cuts[1:]) if end > start]
+
+
+def do_split(re_data, num_splits, keep_class_together=False):
+    buffer = io.BytesIO()
+
+    # Write each split once, straight into the ZIP
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for i, df_split in enumerate(split_data(re_data, num_splits, keep_class_together)):
+            with archive.open(f'Data_{i + 1}.csv', 'w') as csv_file, \
+                    io.TextIOWrapper(csv_file, encoding='utf-8', newline='') as csv_text:
+                df_split.to_csv(csv_text, index=False, lineterminator='\r\n', quoting=1)
+
+    return buffer.getvalue()
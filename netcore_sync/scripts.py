@@ -0,0 +1,28 @@
+import importlib.util
+import logging
+import os
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(name):
+    # The scripts aren't importable by name, as they have spaces in them
+    spec = importlib.util.spec_from_file_location(name.replace(' ', '_'), os.path.join(REPO, f'{name}.py'))
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+
+    return script
+
+
+def run_script(script):
+    # As when the script is run on its own, bar exiting at the end
+    script.start_logging()
+
+    try:
+        script.main()
+    finally:
+        script.stop_logging()
+
+        # Detach the log of the script, so that anything running after it in the same process writes to its own
+        logging.getLogger().removeHandler(script.log_handler)
+        script.log_handler.close()
@@ -0,0 +1,274 @@
+import glob
+import logging
+import os
+import sqlite3
+import pandas as pd
+import pyarrow.parquet as pq
+
+from netcore_sync.diff import EMAIL_COLUMN, HARD_BOUNCE_KEYS, KEY_HASH, UNSUBSCRIBE_KEYS, hash_keys
+from netcore_sync.engagement import ENGAGEMENT_STORE, LEGACY_ENGAGEMENT_FILE, PARTITION, get_engagement_schema, \
+    get_months
+
+# SQLite database mirroring the Parquet files, for indexed lookups
+STATE_DB = 'Databases/Sync State.db'
+
+EMAIL_LIST = 'Databases/Email List.parquet'
+
+# Records already uploaded to RE, by kind
+HISTORY_FILES = {
+    'unsubscribe': ('Databases/Unsubscribes.parquet', UNSUBSCRIBE_KEYS),
+    'hard_bounce': ('Databases/Hard Bounces.parquet', HARD_BOUNCE_KEYS)
+}
+
+# Columns of the engagement data needed to find new unsubscribes and bounces
+ENGAGEMENT_COLUMNS = {
+    EMAIL_COLUMN: 'email',
+    'Subject': 'subject',
+    'Sent Date': 'sent_date',
+    'Open time': 'open_time',
+    'Unsub reason': 'unsub_reason',
+    'Bounce Type': 'bounce_type'
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS email_addresses (
+    id TEXT PRIMARY KEY,
+    address TEXT,
+    email TEXT,
+    constituent_id TEXT,
+    inactive INTEGER
+);
+CREATE INDEX IF NOT EXISTS email_addresses_email ON email_addresses (email);
+
+CREATE TABLE IF NOT EXISTS engagement (
+    key_hash INTEGER PRIMARY KEY,
+    month TEXT,
+    email TEXT,
+    subject TEXT,
+    sent_date TEXT,
+    open_time TEXT,
+    unsub_reason TEXT,
+    bounce_type TEXT,
+    unsubscribe_key INTEGER,
+    hard_bounce_key INTEGER
+);
+CREATE INDEX IF NOT EXISTS engagement_unsubscribe_key ON engagement (unsubscribe_key, month)
+    WHERE unsubscribe_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS engagement_hard_bounce_key ON engagement (hard_bounce_key, month)
+    WHERE hard_bounce_key IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS uploaded (
+    kind TEXT,
+    key_hash INTEGER,
+    PRIMARY KEY (kind, key_hash)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS imported_files (
+    path TEXT PRIMARY KEY,
+    fingerprint TEXT
+);
+'''
+
+
+def to_signed(hashes):
+    # SQLite integers are signed, so store the 64-bit hashes as such
+    return pd.Series(hashes).astype('uint64').to_numpy().view('int64')
+
+
+def get_fingerprint(path):
+    stat = os.stat(path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def to_text(series):
+    # Dates are kept as text, like everything else
+    return series.astype(str).where(series.notna(), None)
+
+
+class StateStore:
+    """
+    Indexed copy of the email list, engagement data and upload history, so that lookups and diffs are SQL queries
+    instead of reading whole Parquet files into pandas.
+
+    The Parquet files stay the source of truth. sync() brings the database up to date with them, importing only the
+    files that changed since the last time, so the first sync is a one-time migration and the ones after are cheap.
+    """
+
+    def __init__(self, database=STATE_DB):
+        self.connection = sqlite3.connect(database)
+
+        # Let the engagement page write while the scripts read
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self.upgrade()
+
+    def upgrade(self):
+        # Databases made before the inactive flag was kept need it added, and the email list imported again
+        columns = [column for _, column, *_ in self.connection.execute('PRAGMA table_info(email_addresses)')]
+
+        if 'inactive' not in columns:
+            with self.connection:
+                self.connection.execute('ALTER TABLE email_addresses ADD COLUMN inactive INTEGER')
+                self.connection.execute('DELETE FROM imported_files WHERE path = ?', (EMAIL_LIST,))
+
+    def is_imported(self, path):
+        row = self.connection.execute('SELECT fingerprint FROM imported_files WHERE path = ?', (path,)).fetchone()
+        return row is not None and row[0] == get_fingerprint(path)
+
+    def mark_imported(self, path):
+        self.connection.execute('INSERT OR REPLACE INTO imported_files VALUES (?, ?)', (path, get_fingerprint(path)))
+
+    def sync(self):
+        logging.info('Bringing the state store up to date')
+
+        self.sync_email_list()
+        self.sync_engagement()
+        self.sync_history()
+
+    def sync_email_list(self):
+        if not os.path.exists(EMAIL_LIST) or self.is_imported(EMAIL_LIST):
+            return
+
+        logging.info(f'Importing {EMAIL_LIST} into the state store')
+
+        # Lists saved before the inactive flag was kept count as active
+        columns = [column for column in ['id', 'address', 'constituent_id', 'inactive']
+                   if column in pq.read_schema(EMAIL_LIST).names]
+
+        df = pd.read_parquet(EMAIL_LIST, columns=columns)
+        df['inactive'] = df.get('inactive')
+        df['email'] = df['address'].astype(str).str.strip().str.lower().where(df['address'].notna(), None)
+
+        # The download replaces the whole list, so do the same here
+        with self.connection:
+            self.connection.execute('DELETE FROM email_addresses')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO email_addresses (id, address, email, constituent_id, inactive) '
+                'VALUES (?, ?, ?, ?, ?)',
+                df[['id', 'address', 'email', 'constituent_id', 'inactive']].astype(object).where(df.notna(), None)
+                .itertuples(index=False, name=None)
+            )
+            self.mark_imported(EMAIL_LIST)
+
+    def add_engagement(self, df, month=None):
+        schema = get_engagement_schema()
+
+        if KEY_HASH not in df.columns or df[KEY_HASH].isna().any():
+            df[KEY_HASH] = hash_keys(df, schema.names)
+
+        if month is None:
+            month = get_months(pd.to_datetime(df['Sent Date']))
+
+        events = pd.DataFrame({column: to_text(df[name]) for name, column in ENGAGEMENT_COLUMNS.items()})
+        events.insert(0, 'key_hash', to_signed(df[KEY_HASH]))
+        events.insert(1, 'month', month)
+
+        # Keys of the unsubscribes and hard bounces, as stored in the upload history
+        unsubscribes = df['Unsub reason'].notna().to_numpy()
+        hard_bounces = (df['Bounce Type'] == 'Hard Bounce').to_numpy()
+
+        events['unsubscribe_key'] = None
+        events['hard_bounce_key'] = None
+
+        if unsubscribes.any():
+            keys = to_signed(hash_keys(df[unsubscribes], UNSUBSCRIBE_KEYS))
+            events.loc[unsubscribes, 'unsubscribe_key'] = keys.tolist()
+
+        if hard_bounces.any():
+            keys = to_signed(hash_keys(df[hard_bounces], HARD_BOUNCE_KEYS))
+            events.loc[hard_bounces, 'hard_bounce_key'] = keys.tolist()
+
+        self.connection.executemany(
+            f'INSERT OR IGNORE INTO engagement ({", ".join(events.columns)}) '
+            f'VALUES ({", ".join("?" * len(events.columns))})',
+            events.astype(object).where(events.notna(), None).itertuples(index=False, name=None)
+        )
+
+    def sync_engagement(self):
+        # Partition files are never changed once written, so each only needs importing once
+        if os.path.isdir(ENGAGEMENT_STORE):
+            files = glob.glob(os.path.join(ENGAGEMENT_STORE, f'{PARTITION}=*', 'part-*.parquet'))
+        else:
+            files = [LEGACY_ENGAGEMENT_FILE] if os.path.exists(LEGACY_ENGAGEMENT_FILE) else []
+
+        imported = 0
+
+        for path in sorted(files):
+            if self.is_imported(path):
+                continue
+
+            df = pq.read_table(path).to_pandas()
+
+            # The month comes from the folder the file is in
+            folder = os.path.basename(os.path.dirname(path))
+            month = folder.split('=', 1)[1] if folder.startswith(f'{PARTITION}=') else None
+
+            with self.connection:
+                self.add_engagement(df, month)
+                self.mark_imported(path)
+
+            imported += 1
+
+        if imported:
+            logging.info(f'Imported {imported} files of engagement data into the state store')
+
+    def sync_history(self):
+        for kind, (history_file, keys) in HISTORY_FILES.items():
+            if not os.path.exists(history_file) or self.is_imported(history_file):
+                continue
+
+            logging.info(f'Importing {history_file} into the state store')
+
+            if KEY_HASH in pq.read_schema(history_file).names:
+                hashes = pd.read_parquet(history_file, columns=[KEY_HASH])[KEY_HASH]
+            else:
+                hashes = hash_keys(pd.read_parquet(history_file, columns=keys), keys)
+
+            with self.connection:
+                self.connection.executemany('INSERT OR IGNORE INTO uploaded VALUES (?, ?)',
+                                            ((kind, int(key_hash)) for key_hash in to_signed(hashes)))
+                self.mark_imported(history_file)
+
+    def lookup_re_ids(self, email, column):
+        # Unique RE IDs of an email, in the order they appear in the list
+        return [re_id for re_id, in self.connection.execute(
+            f'SELECT {column} FROM email_addresses WHERE email = ? GROUP BY {column} ORDER BY MIN(rowid)', (email,)
+        )]
+
+    def is_inactive(self, email_address_id):
+        row = self.connection.execute('SELECT inactive FROM email_addresses WHERE id = ?',
+                                      (email_address_id,)).fetchone()
+        return row is not None and bool(row[0])
+
+    def find_new_events(self, kind, key_column, columns, months=None):
+        # One event per key that isn't in the upload history yet (a left anti-join on the indexes)
+        month_filter = f'AND month IN ({", ".join("?" * len(months))})' if months is not None else ''
+
+        query = f'''
+            SELECT {", ".join(columns)} FROM engagement WHERE rowid IN (
+                SELECT MIN(rowid) FROM engagement e
+                WHERE {key_column} IS NOT NULL {month_filter}
+                AND NOT EXISTS (SELECT 1 FROM uploaded u WHERE u.kind = ? AND u.key_hash = e.{key_column})
+                GROUP BY {key_column}
+            ) ORDER BY rowid
+        '''
+
+        df = pd.read_sql_query(query, self.connection, params=[*(months or []), kind])
+
+        # Back to the columns and types of the Netcore data
+        df = df.rename(columns={column: name for name, column in ENGAGEMENT_COLUMNS.items()})
+        for column in ['Sent Date', 'Open time']:
+            if column in df.columns:
+                df[column] = pd.to_datetime(df[column])
+
+        return df
+
+    def find_new_unsubscribes(self, months=None):
+        return self.find_new_events('unsubscribe', 'unsubscribe_key',
+                                    ['email', 'subject', 'sent_date', 'open_time', 'unsub_reason'], months)
+
+    def find_new_hard_bounces(self, months=None):
+        return self.find_new_events('hard_bounce', 'hard_bounce_key', ['email'], months)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import time
+
+# Where the RE access and refresh tokens are kept, shared by all the scripts
+TOKEN_FILE = 'access_token_output.json'
+
+# Blackbaud OAuth URL, where tokens are refreshed
+OAUTH_URL = 'https://oauth2.sky.blackbaud.com'
+
+# Refresh the access token these many seconds before it expires
+REFRESH_AHEAD = 300
+
+
+def save_token(token, token_file=TOKEN_FILE):
+    # Write to a temporary file and swap it in, so that other scripts never read a half written token
+    temporary_file = f'{token_file}.tmp'
+
+    with open(temporary_file, 'w') as response_output:
+        json.dump(token, response_output, ensure_ascii=False, sort_keys=True, indent=4)
+
+    os.replace(temporary_file, token_file)
+
+
+class TokenManager:
+    """
+    Keeps the RE access token in memory and refreshes it shortly before it expires.
+
+    The token file is only read at start up, or when another process may have refreshed it, and is always
+    replaced atomically so that the other scripts never see a half written token.
+    """
+
+    def __init__(self, http, auth_code, token_file=TOKEN_FILE, oauth_url=OAUTH_URL):
+        self.http = http
+        self.auth_code = auth_code
+        self.oauth_url = oauth_url
+        self.token_file = token_file
+        self.token = None
+        self.token_mtime = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        logging.info('Loading token for API connections')
+
+        token_mtime = os.path.getmtime(self.token_file)
+
+        with open(self.token_file) as access_token_output:
+            token = json.load(access_token_output)
+
+        # The token was issued when the file was written
+        self.token = token
+        self.token_mtime = token_mtime
+        self.expires_at = token_mtime + token.get('expires_in', 0)
+
+    def reload_if_changed(self):
+        # Pick up a token refreshed by another process in the meantime
+        if self.token is None or os.path.getmtime(self.token_file) != self.token_mtime:
+            self.load()
+
+    def is_expiring(self):
+        return time.time() >= self.expires_at - REFRESH_AHEAD
+
+    def request_token(self):
+        logging.info('Refreshing token for API connections')
+
+        requested_at = time.time()
+
+        # Request Headers for Blackbaud API request
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Authorization': 'Basic ' + self.auth_code
+        }
+
+        # Request parameters for Blackbaud API request
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': self.token['refresh_token']
+        }
+
+        response = self.http.post(f'{self.oauth_url}/token', data=data, headers=headers)
+        response.raise_for_status()
+
+        token = response.json()
+
+        save_token(token, self.token_file)
+
+        self.token = token
+        self.token_mtime = os.path.getmtime(self.token_file)
+        self.expires_at = requested_at + token.get('expires_in', 0)
+
+    def refresh(self):
+        with self.lock:
+            self.reload_if_changed()
+            self.request_token()
+
+    def get_access_token(self):
+        if self.token is not None and not self.is_expiring():
+            return self.token['access_token']
+
+        with self.lock:
+            self.reload_if_changed()
+
+            if self.is_expiring():
+                self.request_token()
+
+            return self.token['access_token']
+
+    def handle_unauthorized(self, rejected_token):
+        with self.lock:
+            self.reload_if_changed()
+
+            # Only refresh if nobody else has done so since the token was rejected
+            if self.token['access_token'] == rejected_token:
+                self.request_token()
+
+    def request(self, method, url, headers=None, **kwargs):
+        headers = dict(headers or {})
+
+        access_token = self.get_access_token()
+        headers['Authorization'] = 'Bearer ' + access_token
+
+        response = self.http.request(method, url, headers=headers, **kwargs)
+
+        # Try once more with a fresh token
+        if response.status_code == 401:
+            logging.info('Access token was rejected, refreshing it and trying again')
+
+            self.handle_unauthorized(access_token)
+            headers['Authorization'] = 'Bearer ' + self.get_access_token()
+
+            response = self.http.request(method, url, headers=headers, **kwargs)
+
+        return response
@@ -0,0 +1,252 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from collections import Counter
+
+# Writes to RE yet to succeed, as a journal of events replayed at start up
+WRITE_QUEUE = 'Databases/Write Queue.jsonl'
+
+# Writes that failed for good, kept for someone to look into
+DEAD_LETTERS = 'Databases/Dead Letters.parquet'
+
+# Give up on a write after these many failed runs
+MAX_ATTEMPTS = 10
+
+# Wait this long (in seconds) before trying a failed write again, doubling with every attempt up to a day
+RETRY_BACKOFF = 15 * 60
+RETRY_BACKOFF_MAX = 24 * 60 * 60
+
+# Client errors that may well go away when tried again later (an expired token, the daily quota, throttling)
+RETRYABLE_CLIENT_ERRORS = [401, 403, 408, 429]
+
+
+def get_item_key(kind, method, url, payload):
+    # The same write to the same place is queued only once
+    content = json.dumps([kind, method, url, payload], sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def is_permanent_failure(status_code):
+    return 400 <= status_code < 500 and status_code not in RETRYABLE_CLIENT_ERRORS
+
+
+class WriteQueue:
+    """
+    Persistent queue of the writes (consents, inactive emails) to be made in RE.
+
+    Every write is queued before it's sent and only leaves the queue once RE has accepted it, so that nothing is lost
+    to a failed request or a crashed run. Failed writes are tried again in later runs with an increasing backoff,
+    until they've failed MAX_ATTEMPTS times or RE rejects them outright, when they're moved to the dead letters.
+
+    The queue is kept as a journal, with each change written to disk straight away, and compacted at the end of a run
+    once the rows of the writes completed in it are recorded as uploaded.
+    """
+
+    def __init__(self, queue_file=WRITE_QUEUE, dead_letters_file=DEAD_LETTERS):
+        self.queue_file = queue_file
+        self.dead_letters_file = dead_letters_file
+        self.items = {}
+        self.live_rows = Counter()
+        self.new_dead_letters = []
+
+        # Rows of the writes completed since the queue was last compacted, by kind, which may not have been recorded as
+        # uploaded yet (by a run that crashed in between)
+        self.completed_rows = {}
+
+        # Rows with a write that's failed for good, so that they aren't queued again
+        self.dead_rows = set()
+        if os.path.exists(self.dead_letters_file):
+            for dead_letter in pd.read_parquet(self.dead_letters_file).to_dict('records'):
+                row_keys = dead_letter.get('row_keys')
+
+                # Dead letters from before writes could cover several rows have just the one
+                if not isinstance(row_keys, (list, np.ndarray)):
+                    row_keys = [dead_letter['row_key']]
+
+                self.dead_rows.update((dead_letter['kind'], row_key) for row_key in row_keys)
+
+        self.load()
+
+        self.journal = open(self.queue_file, 'a')
+
+    def load(self):
+        logging.info('Loading the queue of writes to RE')
+
+        if not os.path.exists(self.queue_file):
+            return
+
+        with open(self.queue_file) as journal:
+            for line in journal:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f'Skipping incomplete write queue record: {line}')
+                    continue
+
+                rows = self.apply(event)
+
+                if event['event'] == 'done':
+                    self.completed_rows.setdefault(event['item']['kind'], []).extend(rows)
+
+        logging.info(f'{len(self.items)} writes to RE are pending')
+
+    def apply(self, event):
+        # Hands back the rows a completed write was the last one left for
+        item = event['item']
+
+        # Writes queued before they could cover several rows have just the one
+        if 'rows' not in item:
+            item['rows'] = [[item.pop('row_key'), item.pop('row')]]
+
+        keys = [(item['kind'], row_key) for row_key, row in item['rows']]
+
+        if event['event'] == 'queued':
+            # A write queued again carries more rows, of which only the new ones are counted
+            old_rows = self.items[item['key']]['rows'] if item['key'] in self.items else []
+            self.live_rows.update((item['kind'], row_key) for row_key, row in item['rows']
+                                  if [row_key, row] not in old_rows)
+            self.items[item['key']] = item
+
+        elif item['key'] in self.items:
+            if event['event'] == 'failed':
+                self.items[item['key']] = item
+            else:
+                # Done or dead
+                del self.items[item['key']]
+                self.live_rows.subtract(keys)
+
+            # Dead letters stay in the journal until they're saved at compaction
+            if event['event'] == 'dead':
+                self.dead_rows.update(keys)
+                self.new_dead_letters.append(item)
+
+            # Rows are done once none of their writes are left
+            if event['event'] == 'done':
+                return [row for row_key, row in item['rows'] if self.live_rows[(item['kind'], row_key)] == 0]
+
+        return []
+
+    def record(self, event, item):
+        event = {'event': event, 'item': item}
+
+        # Make sure the change is on disk before moving on
+        self.journal.write(json.dumps(event, default=str) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+        return self.apply(event)
+
+    def has_row(self, kind, row_key):
+        # Whether a row is still being written, or has failed for good
+        return self.live_rows[(kind, row_key)] > 0 or (kind, row_key) in self.dead_rows
+
+    def add(self, kind, rows, method, url, payload):
+        # rows are the [row key, row] the write is for, recorded as uploaded once it (and their other writes) are done
+        key = get_item_key(kind, method, url, payload)
+
+        # The same write for other rows (e.g. the same email twice, in a different case) covers those rows too
+        if key in self.items:
+            item = self.items[key]
+            rows = [row for row in rows if row not in item['rows']]
+
+            if rows:
+                self.record('queued', {**item, 'rows': item['rows'] + rows})
+
+            return
+
+        self.record('queued', {
+            'key': key,
+            'kind': kind,
+            'rows': rows,
+            'method': method,
+            'url': url,
+            'payload': payload,
+            'attempts': 0,
+            'next_attempt': 0,
+            'last_error': None
+        })
+
+    def due(self, kind):
+        # Writes of this kind that are ready to be tried (again)
+        now = time.time()
+        return [item for item in self.items.values() if item['kind'] == kind and item['next_attempt'] <= now]
+
+    def complete(self, item):
+        # Journalled before the rows are recorded as uploaded, so that a crash in between never sends the write again
+        rows = self.record('done', item)
+        self.completed_rows.setdefault(item['kind'], []).extend(rows)
+
+        return rows
+
+    def pop_completed_rows(self, kind):
+        # Rows completed by an earlier run, to record as uploaded (again, if it got to them)
+        return self.completed_rows.pop(kind, [])
+
+    def fail(self, item, error, permanent=False):
+        item = {**item, 'attempts': item['attempts'] + 1, 'last_error': error}
+
+        if permanent or item['attempts'] >= MAX_ATTEMPTS:
+            logging.error(f'Giving up on {item["method"]} {item["url"]} after {item["attempts"]} attempt(s): {error}')
+
+            item['failed_at'] = pd.Timestamp.now().isoformat()
+            self.record('dead', item)
+
+        else:
+            backoff = min(RETRY_BACKOFF * 2 ** (item['attempts'] - 1), RETRY_BACKOFF_MAX)
+            item['next_attempt'] = time.time() + backoff
+
+            logging.warning(f'{item["method"]} {item["url"]} failed ({error}), trying again in {backoff} seconds')
+
+            self.record('failed', item)
+
+    def save_dead_letters(self):
+        if not self.new_dead_letters:
+            return
+
+        logging.info(f'Adding {len(self.new_dead_letters)} writes to the dead letters')
+
+        dead_letters = pd.DataFrame(self.new_dead_letters)
+        dead_letters['row_keys'] = dead_letters['rows'].apply(lambda rows: [row_key for row_key, row in rows])
+
+        # Keep the payloads readable, whatever shape they are
+        for column in ['payload', 'rows']:
+            dead_letters[column] = dead_letters[column].apply(lambda value: json.dumps(value, default=str))
+
+        # A crash during the last compaction may have saved some of them already
+        if os.path.exists(self.dead_letters_file):
+            dead_letters = pd.concat([pd.read_parquet(self.dead_letters_file), dead_letters], ignore_index=True)
+            dead_letters = dead_letters.drop_duplicates('key', keep='last').reset_index(drop=True)
+
+        dead_letters.to_parquet(f'{self.dead_letters_file}.tmp', index=False)
+        os.replace(f'{self.dead_letters_file}.tmp', self.dead_letters_file)
+
+        self.new_dead_letters = []
+
+    def compact(self):
+        logging.info('Compacting the queue of writes to RE')
+
+        self.journal.close()
+
+        # The dead letters go first, so that a crash in between leaves them in the journal to be saved next time
+        self.save_dead_letters()
+
+        # Rewrite the journal with just the writes still pending
+        with open(f'{self.queue_file}.tmp', 'w') as journal:
+            for item in self.items.values():
+                journal.write(json.dumps({'event': 'queued', 'item': item}, default=str) + '\n')
+
+        os.replace(f'{self.queue_file}.tmp', self.queue_file)
+
+        self.journal = open(self.queue_file, 'a')
+
+        # Only compacted once they're recorded as uploaded, as the journal no longer has the writes they came from
+        self.completed_rows = {}
+
+    def close(self):
+        self.compact()
+        self.journal.close()
@@ -2,6 +2,8 @@ import streamlit as st
 import pandas as pd
 import time
 
+from netcore_sync.engagement import append_engagement, check_upload, migrate_legacy_engagement, read_upload
+
 st.set_page_config(
     page_title='Engagement Recorder',
     page_icon=':incoming_envelope:',
@@ -28,29 +30,31 @@ st.markdown('##')
 st.write('##### Upload Data from Netcore')
 st.markdown('##')
 
-try:
-    existing_df = pd.read_parquet('Databases/Netcore Data.parquet')
-except:
-    existing_df = pd.DataFrame()
-
 # Add file uploader for CSV file
 uploaded_files = st.file_uploader('Upload a CSV file', type='csv', accept_multiple_files=True, label_visibility='collapsed')
 
 if uploaded_files:
-    df = pd.DataFrame()
 
-    for uploaded_file in uploaded_files:
-        df_1 = pd.read_csv(uploaded_file, low_memory=False)
-        df = pd.concat([df, df_1])
+    # Check the columns of every file before adding any of them
+    try:
+        for uploaded_file in uploaded_files:
+            check_upload(uploaded_file)
 
-    existing_df = pd.concat([existing_df, df])
-    existing_df = existing_df.drop_duplicates().copy()
+    except ValueError as error:
+        st.error(str(error), icon='🚨')
+        st.stop()
 
-    # Set Datetime format
-    existing_df['Sent Date'] = pd.to_datetime(existing_df['Sent Date'])
-    existing_df['Open time'] = pd.to_datetime(existing_df['Open time'])
+    # Move data from before partitioning into the store
+    migrate_legacy_engagement()
+
+    # Hashes of the rows already stored, by month
+    known_hashes = {}
+
+    for uploaded_file in uploaded_files:
 
-    existing_df.to_parquet('Databases/Netcore Data.parquet', index=False)
+        # Add the new rows to the months they were sent in, a chunk at a time
+        for df in read_upload(uploaded_file):
+            append_engagement(df, known_hashes)
 
     st.markdown('##')
 
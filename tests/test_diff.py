@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from netcore_sync.diff import (EMAIL_COLUMN, HARD_BOUNCE_KEYS, KEY_HASH, UNSUBSCRIBE_KEYS, find_new_rows, hash_keys,
+                               load_history_hashes, with_key_hashes)
+
+
+def make_events(size, seed=0):
+    # Synthetic Netcore unsubscribes, with a few subjects repeated across many emails
+    rng = np.random.default_rng(seed)
+
+    return pd.DataFrame({
+        EMAIL_COLUMN: [f'user{i}@example.com' for i in range(size)],
+        'Subject': rng.choice(['Newsletter', 'Reunion', 'Appeal'], size),
+        'Open time': pd.Timestamp('2024-01-01')
+    })
+
+
+def test_large_history_returns_exactly_the_new_rows():
+    events = make_events(200_000)
+    history = events.sample(frac=0.9, random_state=1)
+    expected = events.drop(history.index)
+
+    new_rows = find_new_rows(events, hash_keys(history, UNSUBSCRIBE_KEYS), UNSUBSCRIBE_KEYS)
+
+    assert sorted(new_rows.index) == sorted(expected.index)
+
+
+def test_rows_only_in_the_history_are_not_returned():
+    events = make_events(10)
+    history = pd.concat([events.iloc[:5], make_events(20, seed=1).iloc[10:]])
+
+    new_rows = find_new_rows(events, hash_keys(history, UNSUBSCRIBE_KEYS), UNSUBSCRIBE_KEYS)
+
+    assert list(new_rows.index) == list(range(5, 10))
+
+
+def test_duplicate_keys_in_the_events_are_all_kept_or_all_dropped():
+    events = pd.DataFrame({
+        EMAIL_COLUMN: ['a@example.com', 'a@example.com', 'b@example.com', 'b@example.com'],
+        'Subject': ['Newsletter'] * 4
+    })
+    history = events.iloc[[0]]
+
+    new_rows = find_new_rows(events, hash_keys(history, UNSUBSCRIBE_KEYS), UNSUBSCRIBE_KEYS)
+
+    assert list(new_rows[EMAIL_COLUMN]) == ['b@example.com', 'b@example.com']
+
+
+def test_emails_match_regardless_of_case_and_whitespace():
+    events = pd.DataFrame({EMAIL_COLUMN: [' User@Example.COM\n', 'other@example.com']})
+    history = pd.DataFrame({EMAIL_COLUMN: ['user@example.com']})
+
+    new_rows = find_new_rows(events, hash_keys(history, HARD_BOUNCE_KEYS), HARD_BOUNCE_KEYS)
+
+    assert list(new_rows[EMAIL_COLUMN]) == ['other@example.com']
+
+
+def test_subjects_still_match_exactly():
+    events = pd.DataFrame({EMAIL_COLUMN: ['user@example.com'] * 2, 'Subject': ['Newsletter', 'NEWSLETTER']})
+    history = events.iloc[[0]]
+
+    new_rows = find_new_rows(events, hash_keys(history, UNSUBSCRIBE_KEYS), UNSUBSCRIBE_KEYS)
+
+    assert list(new_rows['Subject']) == ['NEWSLETTER']
+
+
+def test_empty_history_returns_every_row():
+    events = make_events(5)
+
+    assert find_new_rows(events, pd.Series(dtype='uint64'), UNSUBSCRIBE_KEYS).equals(events)
+
+
+def test_legacy_history_without_key_hash_matches_one_with_it(tmp_path):
+    history = make_events(1_000)
+    history['Open time'] = history['Open time'].astype(str)
+
+    legacy_file = tmp_path / 'legacy.parquet'
+    history.to_parquet(legacy_file, index=False)
+
+    hashed_file = tmp_path / 'hashed.parquet'
+    with_key_hashes(history, UNSUBSCRIBE_KEYS).to_parquet(hashed_file, index=False)
+
+    legacy_hashes = load_history_hashes(legacy_file, UNSUBSCRIBE_KEYS)
+    stored_hashes = load_history_hashes(hashed_file, UNSUBSCRIBE_KEYS)
+
+    assert KEY_HASH in pd.read_parquet(hashed_file).columns
+    assert list(legacy_hashes) == list(stored_hashes)
+
+    events = make_events(1_500)
+    assert find_new_rows(events, legacy_hashes, UNSUBSCRIBE_KEYS).equals(
+        find_new_rows(events, stored_hashes, UNSUBSCRIBE_KEYS))
+    assert list(find_new_rows(events, stored_hashes, UNSUBSCRIBE_KEYS).index) == list(range(1_000, 1_500))
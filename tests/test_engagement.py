@@ -0,0 +1,56 @@
+import io
+import os
+
+import pandas as pd
+import pytest
+
+from netcore_sync.engagement import REQUIRED_COLUMNS, read_upload
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def in_repo(monkeypatch):
+    # The template is read relative to the root of the repo, as the scripts are run from there
+    monkeypatch.chdir(REPO)
+
+
+def make_upload(text):
+    # Like the files handed over by st.file_uploader
+    upload = io.BytesIO(text.encode('utf-8'))
+    upload.name = 'report.csv'
+    return upload
+
+
+def read_all(source):
+    return pd.concat(read_upload(source), ignore_index=True)
+
+
+def test_laid_out_like_the_template():
+    header = open('Templates/Netcore Email Stats.csv').readline().strip()
+    row = ('a@example.com, Campaign 1, Newsletter, 2024-01-01 10:00:00, Hard Bounce, Mailbox full, , , , 0, , , , '
+           'Not interested, , ')
+
+    df = read_all(make_upload(f'{header}\n{row}\n'))
+
+    assert list(df.columns) == [column.strip() for column in header.split(',')]
+    assert df.loc[0, 'EMAIL (Primary Key)'] == 'a@example.com'
+    assert df.loc[0, 'Bounce Type'] == 'Hard Bounce'
+    assert df.loc[0, 'Unsub reason'] == 'Not interested'
+    assert df.loc[0, 'Sent Date'] == '2024-01-01 10:00:00'
+
+
+def test_extra_columns_are_dropped_and_values_kept_as_text():
+    df = read_all(make_upload(
+        'EMAIL (Primary Key),Subject,Sent Date,Open time,Bounce Type,Unsub reason,Extra\n'
+        'a@example.com,Newsletter,2024-01-01 10:00:00,,,Not interested,x\n'
+        '00123@example.com,2024,2024-01-02 10:00:00,,Hard Bounce,,y\n'
+    ))
+
+    assert list(df.columns) == REQUIRED_COLUMNS
+    assert list(df['Subject']) == ['Newsletter', '2024']
+
+
+def test_missing_required_columns_are_an_error():
+    with pytest.raises(ValueError, match='report.csv is missing the columns: Bounce Type, Unsub reason'):
+        read_all(make_upload('EMAIL (Primary Key),Subject,Sent Date,Open time\na@example.com,Newsletter,,\n'))
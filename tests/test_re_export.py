@@ -0,0 +1,64 @@
+import random
+import re
+
+import numpy as np
+import pandas as pd
+
+from netcore_sync.re_export import EMAIL_REGEX, sanitise_emails
+
+
+# How the page cleaned emails one at a time before sanitise_emails, kept as the reference it must match
+def is_valid_email(email: str) -> bool:
+    if bool(re.match(EMAIL_REGEX, email)) == True: return email
+    else: return np.nan
+
+
+def remove_non_ascii_chars(input_string):
+    return ''.join(char for char in input_string if ord(char) < 128)
+
+
+def sanitise_emails_one_by_one(emails):
+    return emails.apply(remove_non_ascii_chars).str.strip().apply(is_valid_email)
+
+
+def assert_same_as_before(emails):
+    emails = pd.Series(emails, dtype=object)
+
+    pd.testing.assert_series_equal(sanitise_emails(emails), sanitise_emails_one_by_one(emails), check_dtype=False)
+
+
+def test_valid_and_invalid_emails():
+    assert_same_as_before([
+        'user@example.com', 'first.last+tag@mail.example.co.in', "o'brien@example.ie", 'user@example', 'user@@example.com',
+        'user@example.c', 'user@exa_mple.com', '@example.com', 'user@', '', 'not an email', 'user@example.com.'
+    ])
+
+
+def test_non_ascii_characters_are_removed():
+    assert_same_as_before([
+        'usér@example.com', 'user@exämple.com', '用户@example.com', 'user@example.com\u200b', '\ufeffuser@example.com',
+        'ü@example.com', 'user@example.cöm', 'üüü'
+    ])
+
+
+def test_apostrophe_in_the_pattern():
+    # The pattern allows ’, but it's removed as a non-ASCII character before the pattern is applied
+    assert_same_as_before(['o’brien@example.ie', '’@example.com', 'user’@example.com', '’’'])
+
+
+def test_surrounding_whitespace_and_trailing_newline():
+    assert_same_as_before([
+        ' user@example.com', 'user@example.com ', '\tuser@example.com\t', 'user@example.com\n', 'user@example.com\r\n',
+        '\nuser@example.com\n', 'user @example.com', 'user@example.com\n\n', ' user@example.com ', '   '
+    ])
+
+
+def test_random_strings():
+    rng = random.Random(0)
+    alphabet = 'abcXYZ019.!#$%&’*+/=?^_`{|}~-@ \t\néü用\u200b'
+
+    emails = [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 20))) for _ in range(20_000)]
+    emails += [rng.choice(['', ' ', 'é']) + f'user{i}@example.' + rng.choice(['com', 'c', 'co.uk', 'cöm'])
+               + rng.choice(['', '\n', ' ']) for i in range(20_000)]
+
+    assert_same_as_before(emails)
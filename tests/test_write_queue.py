@@ -0,0 +1,81 @@
+import pytest
+
+from netcore_sync.write_queue import WriteQueue
+
+URL = 'https://api.sky.blackbaud.com/commpref/v1/consent/consents'
+
+
+@pytest.fixture
+def files(tmp_path):
+    return {'queue_file': tmp_path / 'Write Queue.jsonl', 'dead_letters_file': tmp_path / 'Dead Letters.parquet'}
+
+
+def make_row(row_key):
+    return [row_key, {'EMAIL (Primary Key)': f'{row_key}@example.com'}]
+
+
+def test_rows_are_done_once_all_their_writes_are(files):
+    queue = WriteQueue(**files)
+    queue.add('consent', [make_row('a'), make_row('b')], 'POST', URL, {'constituent_id': '1'})
+    queue.add('consent', [make_row('b')], 'POST', URL, {'constituent_id': '2'})
+
+    first, second = queue.due('consent')
+
+    assert queue.complete(first) == [make_row('a')[1]]
+    assert queue.complete(second) == [make_row('b')[1]]
+    assert queue.due('consent') == []
+
+
+def test_completed_writes_are_recovered_after_a_crash(files):
+    queue = WriteQueue(**files)
+    queue.add('consent', [make_row('a'), make_row('b')], 'POST', URL, {'constituent_id': '1'})
+    queue.add('consent', [make_row('b')], 'POST', URL, {'constituent_id': '2'})
+    queue.add('consent', [make_row('c')], 'POST', URL, {'constituent_id': '3'})
+
+    first, second, third = queue.due('consent')
+    queue.complete(first)
+    queue.complete(second)
+
+    # A crash before the rows were recorded as uploaded, and before the queue was compacted
+    queue.journal.close()
+    queue = WriteQueue(**files)
+
+    # The completed writes aren't sent again, and their rows are handed back to be recorded
+    assert [item['key'] for item in queue.due('consent')] == [third['key']]
+    assert queue.pop_completed_rows('consent') == [make_row('a')[1], make_row('b')[1]]
+    assert queue.pop_completed_rows('consent') == []
+    assert not queue.has_row('consent', 'a')
+    assert queue.has_row('consent', 'c')
+
+
+def test_completed_rows_are_kept_until_the_queue_is_compacted(files):
+    queue = WriteQueue(**files)
+    queue.add('inactive', [make_row('a')], 'PATCH', f'{URL}/1', {'inactive': True})
+    queue.complete(queue.due('inactive')[0])
+
+    assert queue.completed_rows == {'inactive': [make_row('a')[1]]}
+
+    queue.compact()
+    assert queue.completed_rows == {}
+
+    queue.journal.close()
+    assert WriteQueue(**files).pop_completed_rows('inactive') == []
+
+
+def test_the_same_write_for_other_rows_covers_them_too(files):
+    queue = WriteQueue(**files)
+    queue.add('inactive', [make_row('a')], 'PATCH', f'{URL}/1', {'inactive': True})
+    queue.add('inactive', [make_row('b')], 'PATCH', f'{URL}/1', {'inactive': True})
+    queue.add('inactive', [make_row('b')], 'PATCH', f'{URL}/1', {'inactive': True})
+
+    assert len(queue.due('inactive')) == 1
+    assert queue.has_row('inactive', 'b')
+
+    # Still the case once the journal is replayed
+    queue.journal.close()
+    queue = WriteQueue(**files)
+
+    item, = queue.due('inactive')
+    assert item['rows'] == [make_row('a'), make_row('b')]
+    assert queue.complete(item) == [make_row('a')[1], make_row('b')[1]]
+    assert not queue.has_row('inactive', 'a') and not queue.has_row('inactive', 'b')